@@ -0,0 +1,53 @@
+import os
+
+import requests
+from email.mime.image import MIMEImage
+
+ASSETS_DIR = os.getenv("ASSETS_DIR", "assets")
+
+#* name -> (local file, fallback URL)
+BANNERS = {
+    "top_banner": ("top_banner.jpg", os.getenv("TOP_BANNER_URL", "https://placehold.co/970x40/057dc7/fff/jpg?text=Placeholder")),
+    "bottom_banner": ("bottom_banner.jpg", os.getenv("BOTTOM_BANNER_URL", "https://placehold.co/970x20/057dc7/fff/jpg?text=Placeholder"))
+}
+
+_parts = {}
+_loaded = False
+
+def _load_bytes(name, filename, url):
+    path = os.path.join(ASSETS_DIR, filename)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    try: #* Download once and keep a local copy for the next start
+        resp = requests.get(url, timeout=10)
+        resp.raise_for_status()
+        data = resp.content
+        os.makedirs(ASSETS_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return data
+    except Exception as e:
+        print(f"Could not load banner '{name}' ({e}). Sending replies without it.")
+        return None
+
+def load_banners():
+    """Loads all banners once and prebuilds their MIME parts (already base64 encoded)."""
+    global _loaded
+    for name, (filename, url) in BANNERS.items():
+        data = _load_bytes(name, filename, url)
+        if not data: #* Fallback: the HTML shows the alt text instead of the image
+            continue
+        part = MIMEImage(data, 'jpeg')
+        part.add_header('Content-Id', f'<{name}>')
+        part.add_header("Content-Disposition", "inline", filename=name)
+        _parts[name] = part
+    _loaded = True
+    print(f"Loaded {len(_parts)} banner(s).")
+
+def banner_parts():
+    """Returns the cached banner parts. They are only read when a message is serialized, so replies can share them."""
+    if not _loaded:
+        load_banners()
+    return list(_parts.values())
@@ -0,0 +1,291 @@
+import os
+import time
+import asyncio
+
+import aiohttp
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import extracter
+import sender
+from attachments import Attachment, budget, close_all, BASE64_OVERHEAD
+from conversation_store import AsyncConversationStore
+from rate_limiter import rate_limiter, estimate_cost
+from metrics import metrics, new_record, log_record, use_record, annotate
+from thread_queue import merge, job_messages, ANSWER, HELD, RUNNING
+from leases import create_leases, LEASE_BACKEND
+from config import LABELS, POLL_INTERVAL, get_mongo_uri
+from clients import client
+from gmail_labels import label_name
+from streaming import GenerationTimeout
+from outbox import outbox, FINAL_LABELS #* Sends from its own threads with the blocking Gmail pool
+from engine_common import router, ACTIVE_THREADS, resolve_request, reclaim_stuck, still_open
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1/users/me"
+QUEUE_SIZE = int(os.getenv("ASYNC_QUEUE_SIZE", "100")) #* Max. jobs waiting between two stages
+STAGE_CONCURRENCY = int(os.getenv("ASYNC_STAGE_CONCURRENCY", "20")) #* Parallel jobs in the Gmail/render stages
+AI_CONCURRENCY = int(os.getenv("ASYNC_AI_CONCURRENCY", "1000")) #* Parallel AI requests, they are only waiting on the network
+
+class AsyncGmail:
+    """Minimal Gmail REST client on aiohttp. The token comes from the (shared) GmailPool credentials."""
+
+    def __init__(self, pool, session):
+        self.pool = pool
+        self.session = session
+
+    async def _request(self, op, method, path, **kwargs):
+        if not self.pool.creds.valid:
+            await asyncio.to_thread(self.pool.ensure_token)
+        headers = {"Authorization": f"Bearer {self.pool.creds.token}"}
+        with metrics.timer("gmail_seconds", op=op):
+            async with self.session.request(method, GMAIL_API + path, headers=headers, **kwargs) as resp:
+                resp.raise_for_status()
+                return await resp.json()
+
+    async def get_message(self, msg_id):
+        return await self._request("get", "GET", f"/messages/{msg_id}", params={"format": "full"})
+
+    async def get_attachment(self, msg_id, att_id):
+        return await self._request("attachment", "GET", f"/messages/{msg_id}/attachments/{att_id}")
+
+    async def modify(self, msg_id, label):
+        metrics.inc("labels_total", label=label_name(label))
+        annotate(label=label_name(label))
+        return await self._request("modify", "POST", f"/messages/{msg_id}/modify", json={"addLabelIds": label["add"], "removeLabelIds": label["remove"]})
+
+class AsyncEngine:
+    """asyncio version of handle_message().
+
+    Every message is a job dict that moves through the stages
+    fetch -> resolve -> ai -> render -> queue, connected by bounded
+    queues. Each stage runs a fixed number of consumer tasks, so a slow stage
+    applies back pressure to the ones before it instead of piling up threads.
+    """
+
+    def __init__(self, pool, sync):
+        self.pool = pool
+        self.sync = sync
+        self.stages = [
+            ("fetch", self.fetch, STAGE_CONCURRENCY),
+            ("resolve", self.resolve, STAGE_CONCURRENCY),
+            ("ai", self.ask_ai, AI_CONCURRENCY),
+            ("render", self.render, STAGE_CONCURRENCY),
+            ("queue", self.queue, STAGE_CONCURRENCY)
+        ]
+        self.queues = [asyncio.Queue(maxsize=QUEUE_SIZE) for _ in self.stages]
+        self._requeued = set()
+        for (name, _, _), q in zip(self.stages, self.queues):
+            metrics.gauge(f"async_queue_depth_{name}", q.qsize)
+
+    async def run(self):
+        async with aiohttp.ClientSession() as session:
+            self.gmail = AsyncGmail(self.pool, session)
+            self.db = AsyncConversationStore(AsyncIOMotorClient(get_mongo_uri())["convoDB"]["conversations"])
+            await self.db.ensure_indexes()
+            if LEASE_BACKEND == "mongo": #* Leases are taken from worker threads, so they use the blocking driver
+                ACTIVE_THREADS.leases = await asyncio.to_thread(create_leases, database=pymongo.MongoClient(get_mongo_uri())["convoDB"])
+            else:
+                ACTIVE_THREADS.leases = create_leases()
+            outbox.start(self.pool, ACTIVE_THREADS) #* After the leases, replies left over from the last run take their thread's lease first
+
+            tasks = [asyncio.create_task(self.db.run_expiry_flusher())]
+            for i, (name, func, concurrency) in enumerate(self.stages):
+                out_queue = self.queues[i + 1] if i + 1 < len(self.queues) else None
+                for _ in range(concurrency):
+                    tasks.append(asyncio.create_task(self._consume(name, func, self.queues[i], out_queue)))
+            print(f"Async engine started ({len(tasks)} tasks).")
+
+            try:
+                await self.ingest()
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def ingest(self):
+        while True:
+            try:
+                messages = await asyncio.to_thread(self.sync.fetch_new)
+                try:
+                    messages += await asyncio.to_thread(reclaim_stuck, self.pool)
+                except Exception as e: #* Retried with the next RECLAIM_INTERVAL, the new messages are handed off anyway
+                    print(f"Could not list the stuck messages: {e}")
+                retry = []
+                for message in messages:
+                    try:
+                        claim = await asyncio.to_thread(ACTIVE_THREADS.claim, message) #* Can be a lease request to Mongo
+                    except Exception as e: #* e.g. the lease store is not reachable, the sync returns it again
+                        print(f"Could not claim thread {message['threadId']}: {e}")
+                        retry.append(message)
+                        continue
+                    if claim == HELD: #* Answered together with the other held messages after the current turn
+                        print(f"Thread {message['threadId']} is already being processed. Holding {message['id']} for the next turn.")
+                        try:
+                            await self.gmail.modify(message['id'], LABELS["progressing"])
+                        except Exception as e: #* Only a marker, the held message is answered anyway
+                            print(f"Could not label {message['id']}: {e}")
+                        continue
+                    if claim == RUNNING: #* Listed again while it is being answered
+                        continue
+                    if claim != ANSWER:
+                        print(f"Thread {message['threadId']} is handled by another instance. Skipping {message['id']}.")
+                        continue
+                    await self.queues[0].put(self.new_job(message)) #* Blocks when the pipeline is full
+                await asyncio.to_thread(self.sync.commit, retry) #* Only now the cursor moves, an exception above leaves the batch to be fetched again
+            except Exception as e:
+                print(f"[{time.ctime()}] Fehler in ingest(): {e}")
+            await asyncio.to_thread(self.sync.wait, POLL_INTERVAL)
+
+    def new_job(self, message):
+        msg_ids = [m['id'] for m in job_messages(message)]
+        return {"message": message, "msg_id": message['id'], "msg_ids": msg_ids, "attachments": [], "start": time.perf_counter(), "metrics": new_record(message['id'])}
+
+    async def label_all(self, job, label): #* Every message of a (merged) turn
+        await asyncio.gather(*(self.gmail.modify(msg_id, label) for msg_id in job["msg_ids"]))
+
+    async def _consume(self, name, func, in_queue, out_queue):
+        while True:
+            job = await in_queue.get()
+            try:
+                with use_record(job["metrics"]), metrics.timer("stage_seconds", stage=name): #* Timings inside the stage count for this job
+                    result = await func(job)
+                if result is not None and out_queue is not None:
+                    await out_queue.put(result)
+                    continue
+            except Exception as e:
+                print(f"A error appeared inside stage '{name}'. {e}")
+                job["metrics"]["error"] = str(e)
+                try:
+                    await self.label_all(job, LABELS["answered"])
+                except Exception as label_error:
+                    print(f"Could not label {job['msg_id']}: {label_error}")
+            finally:
+                in_queue.task_done()
+            await self.finish(job) #* Job left the pipeline (done, dropped or failed)
+
+    async def finish(self, job):
+        close_all(job["attachments"])
+        log_record(job["metrics"])
+        print(f"Message {job['msg_id']} finished in {time.perf_counter() - job['start']:.2f} seconds.")
+        held = await asyncio.to_thread(ACTIVE_THREADS.finish, job["message"]['threadId'])
+        if held: #* Messages that arrived during this turn, the thread stays claimed for them
+            task = asyncio.create_task(self.queues[0].put(self.new_job(merge(held)))) #* Not awaited, the first queue may be full
+            self._requeued.add(task)
+            task.add_done_callback(self._requeued.discard)
+
+    async def _download(self, msg_id, part):
+        attachment = Attachment(part['filename'], part['body'].get('size', 0), part['mimeType'])
+        if 'data' in part['body']:
+            await asyncio.to_thread(attachment.write_base64, part['body']['data'])
+            return attachment
+
+        reserved = await budget.acquire_async(int(attachment.size * BASE64_OVERHEAD))
+        try: #! Directly after the reservation, a cancellation in between would leak it
+            att = await self.gmail.get_attachment(msg_id, part['body']['attachmentId'])
+            await asyncio.to_thread(attachment.write_base64, att.pop('data'))
+        finally:
+            budget.release(reserved)
+        return attachment
+
+    async def _fetch_one(self, job, msg_id):
+        msg = await self.gmail.get_message(msg_id)
+        subject, to, body, message_id, thread_id, attachment_parts = extracter.parse_message(msg)
+
+        attachments = []
+        results = await asyncio.gather(*(self._download(msg_id, part) for part in attachment_parts), return_exceptions=True)
+        for part, result in zip(attachment_parts, results):
+            if isinstance(result, Exception):
+                print(f"Error downloading attachment '{part['filename']}': {result}")
+            else:
+                attachments.append(result)
+        job["attachments"].extend(attachments) #* Closed in finish(), also when a later message fails
+        return subject, to, body, message_id, thread_id, attachments
+
+    async def fetch(self, job):
+        job["msg_ids"] = await asyncio.to_thread(still_open, self.pool, job["message"]) #* Some may have been answered in the meantime
+        if not job["msg_ids"]:
+            return None
+        await self.label_all(job, LABELS["progressing"])
+        details = await asyncio.gather(*(self._fetch_one(job, msg_id) for msg_id in job["msg_ids"]))
+        subject, to, body, message_id, thread_id, _ = extracter.merge_details(details)
+        job.update(subject=subject, to=to.split('<')[1].split('>')[0], body=body, message_id=message_id, thread_id=thread_id)
+        queued = await asyncio.to_thread(outbox.adopt, thread_id, message_id, job["msg_ids"])
+        if queued: #* Redelivered or reclaimed after the answer was generated
+            print(f"Reply to '{message_id}' is already in the outbox ({queued}).")
+            if queued in FINAL_LABELS:
+                await self.label_all(job, LABELS[FINAL_LABELS[queued]])
+            return None
+        return job
+
+    async def resolve(self, job):
+        request = resolve_request(job["to"])
+        if request["error"] == "inactive":
+            print(f"Model '{request['model']}' is deactivated.")
+            await self.label_all(job, LABELS["broken"]) #* Needs a final label, otherwise it is reclaimed forever
+            return None
+        if request["error"] in ("unregistered", "broken"):
+            print(f"Error: User '{job['to']}' cant use Model '{request['model']}'.")
+            await self.label_all(job, LABELS[request["error"]])
+            return None
+        job.update(request)
+        return job
+
+    async def _acquire(self, model, plan, cost):
+        """Waits until the rate limiter has budget. The job stays in this stage, which holds back the ones before it."""
+        while True:
+            reservation, wait = rate_limiter.try_acquire(model, plan, cost)
+            if reservation:
+                return reservation
+            await asyncio.sleep(wait)
+
+    async def ask_ai(self, job):
+        user = job["user"]
+        user_id = user["user_id"] if user else 0
+        cost = estimate_cost(job["body"], job["attachments"])
+        async def reserve(model):
+            return await self._acquire(model, job["plan"], cost)
+
+        async def ask(model, reservation):
+            try:
+                answer = await sender.ask_AI_async(client, model, job["body"], job["attachments"], self.db, job["thread_id"], user_id, job["plan"])
+            except Exception:
+                rate_limiter.settle(reservation, 0)
+                raise
+            rate_limiter.settle(reservation, answer.usage_metadata.total_token_count if answer else 0)
+            return answer
+
+        ai_start_time = time.perf_counter()
+        try:
+            job["model"], answer = await router.ask_async(job["model"], ask, reserve)
+        except GenerationTimeout as e: #* Counted against the model's circuit, the message is not retried
+            print(f"{e} Message {job['msg_id']}.")
+            answer = None
+
+        if not answer:
+            print(f"Error: No answer generated for message {job['msg_id']}.")
+            await self.label_all(job, LABELS["broken"])
+            return None
+        metrics.inc("tokens_total", answer.usage_metadata.total_token_count, model=job["model"], plan=job["plan"])
+        job["metrics"].update(model=job["model"], plan=job["plan"], tokens=answer.usage_metadata.total_token_count)
+        print(f"Costed {str(answer.usage_metadata.total_token_count)} Tokens using '{job['model']}' model. ({time.perf_counter() - ai_start_time:.2f}s)")
+        job["answer"] = answer
+        close_all(job["attachments"]) #* Not needed anymore, free the memory budget early
+        job["attachments"] = []
+        return job
+
+    async def render(self, job):
+        answer = job["answer"]
+        with metrics.timer("render_seconds"):
+            job["reply"] = await asyncio.to_thread(
+                sender.build_reply, job["to"], job["subject"], job["thread_id"], job["message_id"], answer.text,
+                job["model"], job["plan"], str(answer.usage_metadata.total_token_count), job["tokens"]
+            )
+        if not job["reply"]:
+            print("Error: HTML content is empty. Cannot send reply.")
+            await self.label_all(job, LABELS["broken"])
+            return None
+        return job
+
+    async def queue(self, job): #* The outbox sends the reply and labels the messages "answered" once Gmail accepted it
+        if not await asyncio.to_thread(outbox.enqueue, job["thread_id"], job["message_id"], job["msg_ids"], job["reply"]):
+            print(f"A reply to '{job['message_id']}' is already queued, not sending it twice.")
+        return job
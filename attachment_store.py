@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import threading
+
+from attachments import Attachment
+from clients import keyring
+from crypto_utils import seal_bytes, open_bytes
+
+ATTACHMENT_STORE = os.getenv("ATTACHMENT_STORE", "disk") #* "disk" (encrypted, content addressed) or "none" (attachments only count for their own turn)
+STORE_DIR = os.getenv("ATTACHMENT_STORE_DIR", "attachment_store")
+KEEP_DAYS = int(os.getenv("ATTACHMENT_STORE_DAYS", "7")) #* Files unused for this long are deleted, like the conversations that reference them
+UPLOAD_TTL = 47 * 3600 #* The Files API keeps uploads for 48 hours
+CLEANUP_INTERVAL = 3600
+
+class AttachmentStore:
+    """Attachments stored once by the SHA-256 of their content, encrypted with the chat keyring.
+
+    The conversation document only keeps references ({"sha256", "name", "mimeType", "size"}),
+    so follow-up turns can send the files again without downloading them from Gmail.
+    The same file sent by several users or in several threads is stored (and uploaded) once.
+    """
+
+    def __init__(self, directory=STORE_DIR, keep_days=KEEP_DAYS):
+        self.directory = directory
+        self.keep_days = keep_days
+        self._last_cleanup = 0
+        self._lock = threading.Lock()
+
+    def _path(self, sha256, suffix=""):
+        return os.path.join(self.directory, sha256 + suffix)
+
+    def put(self, attachment):
+        """Stores the attachment unless its content is already there. Returns the reference."""
+        path = self._path(attachment.sha256)
+        if os.path.exists(path):
+            os.utime(path) #* Used again, keep it longer
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            blob = seal_bytes(keyring, attachment.stream().read(), compress=attachment.mimeType.startswith("text/"))
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, path) #* Atomic, a concurrent put of the same content writes the same plaintext
+        self.maybe_cleanup()
+        return {"sha256": attachment.sha256, "name": attachment.name, "mimeType": attachment.mimeType, "size": attachment.size}
+
+    def put_all(self, attachments):
+        refs = []
+        for attachment in attachments:
+            try:
+                refs.append(self.put(attachment))
+            except Exception as e:
+                print(f"Could not store attachment '{attachment.name}': {e}")
+        return refs
+
+    def load(self, ref):
+        """Decrypts a stored attachment into a new Attachment (close it after use), or None if it is gone."""
+        path = self._path(ref["sha256"])
+        try:
+            with open(path, "rb") as f:
+                data = open_bytes(keyring, f.read())
+            os.utime(path) #* Still referenced by an active thread
+        except FileNotFoundError:
+            return None
+        attachment = Attachment(ref["name"], len(data), ref["mimeType"])
+        attachment.write(data)
+        return attachment
+
+    def load_all(self, refs):
+        attachments = []
+        for ref in refs:
+            try:
+                attachment = self.load(ref)
+            except Exception as e:
+                print(f"Could not load stored attachment '{ref['name']}': {e}")
+                continue
+            if attachment is None:
+                print(f"Stored attachment '{ref['name']}' expired, it is no longer sent.")
+            else:
+                attachments.append(attachment)
+        return attachments
+
+    def uploaded(self, sha256):
+        """URI of an earlier Files API upload of this content, if it has not expired yet."""
+        try:
+            with open(self._path(sha256, ".upload"), encoding="utf-8") as f:
+                upload = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return upload["uri"] if upload["expires"] > time.time() else None
+
+    def remember_upload(self, sha256, uploaded):
+        expires = getattr(uploaded, "expiration_time", None)
+        expires = expires.timestamp() - 3600 if expires else time.time() + UPLOAD_TTL #* Some margin, the request takes a while
+        with open(self._path(sha256, ".upload"), "w", encoding="utf-8") as f:
+            json.dump({"uri": uploaded.uri, "expires": expires}, f)
+
+    def maybe_cleanup(self):
+        with self._lock:
+            if time.monotonic() - self._last_cleanup < CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = time.monotonic()
+        deadline = time.time() - self.keep_days * 86400
+        for entry in os.scandir(self.directory) if os.path.isdir(self.directory) else []:
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError:
+                pass #* Removed by another instance
+
+def unique(refs): #* A thread may reference the same content several times
+    seen = set()
+    return [ref for ref in refs if not (ref["sha256"] in seen or seen.add(ref["sha256"]))]
+
+attachment_store = AttachmentStore() if ATTACHMENT_STORE == "disk" else None
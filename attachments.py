@@ -0,0 +1,201 @@
+import os
+import base64
+import asyncio
+import hashlib
+import threading
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import genai_types as types
+from metrics import metrics
+
+MEMORY_BUDGET = int(os.getenv("ATTACHMENT_MEMORY_BUDGET", str(256 * 1024 * 1024))) #* Bytes of attachment data allowed in RAM for the whole process
+SPOOL_MAX_IN_MEMORY = 1024 * 1024 #* Larger attachments are spooled to a temp file on disk
+DECODE_CHUNK = 1024 * 1024 #* Must be a multiple of 4 (base64 block size)
+DOWNLOAD_THREADS = int(os.getenv("ATTACHMENT_DOWNLOAD_THREADS", "4"))
+BASE64_OVERHEAD = 1.4 #* Base64 string + JSON response while downloading
+BUDGET_POLL = 0.05 #* Seconds between checks while the budget is full (event loop only)
+INLINE_LIMIT = 19900000 #* Max. total size of inline attachments per request (19,90 MB), everything above is uploaded
+
+ALLOWED_FILE_TYPES = ["image/png", "image/jpeg", "image/webp", "image/heic", "image/heif", 
+                      "application/pdf", "application/x-javascript", "text/javascript", "application/x-python", "text/x-python", "text/plain", "text/html", "text/css", "text/md", "text/csv", "text/xml", "text/rtf",
+                      "audio/wav", "audio/mp3", "audio/aiff", "audio/aac", "audio/ogg", "audio/flac"]
+
+class MemoryBudget:
+    """Counting limit for attachment bytes held in memory. `acquire()` blocks until enough budget is free."""
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount):
+        amount = min(amount, self.total) #* A single file larger than the budget may still run, but alone
+        with self._cond, metrics.timer("lock_wait_seconds", lock="memory_budget"):
+            self._cond.wait_for(lambda: self.used + amount <= self.total)
+            self.used += amount
+        return amount
+
+    def try_acquire(self, amount):
+        """Non-blocking acquire() for the event loop. Returns the reserved amount, or None if the budget is full."""
+        amount = min(amount, self.total)
+        with self._cond:
+            if self.used + amount > self.total:
+                return None
+            self.used += amount
+        return amount
+
+    async def acquire_async(self, amount):
+        """acquire() for the event loop. Blocking in an executor thread could take the threads the holders need to finish."""
+        with metrics.timer("lock_wait_seconds", lock="memory_budget"):
+            while True:
+                reserved = self.try_acquire(amount)
+                if reserved is not None:
+                    return reserved
+                await asyncio.sleep(BUDGET_POLL)
+
+    def release(self, amount):
+        if amount <= 0:
+            return
+        with self._cond:
+            self.used -= amount
+            self._cond.notify_all()
+
+budget = MemoryBudget(MEMORY_BUDGET)
+_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS, thread_name_prefix="Attachment")
+
+class Attachment:
+    """Decoded attachment kept in a spooled temp file instead of a bytes object."""
+
+    def __init__(self, name, size, mime_type):
+        self.name = name
+        self.size = size
+        self.mimeType = mime_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_IN_MEMORY)
+        self._reserved = 0
+        self._prepaid = False #* The budget for read() was reserved by reserve_inline()
+        self._hash = hashlib.sha256() #* Content address in the attachment store, computed while decoding
+
+    def __getitem__(self, key): #* Keeps the old dict style access (attachment["size"]) working
+        return getattr(self, key)
+
+    def write_base64(self, data):
+        for i in range(0, len(data), DECODE_CHUNK):
+            chunk = data[i:i + DECODE_CHUNK]
+            chunk += "=" * (-len(chunk) % 4) #* Gmail sometimes strips the padding
+            self.write(base64.urlsafe_b64decode(chunk))
+
+    def write(self, data):
+        self._hash.update(data)
+        self.file.write(data)
+        self.size = self.file.tell()
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def read(self):
+        """Returns the whole content as bytes. The memory is counted against the budget until `close()`."""
+        if not self._prepaid:
+            self._reserved += budget.acquire(self.size)
+        self.file.seek(0)
+        return self.file.read()
+
+    def stream(self):
+        """Returns the file object rewound to the start, e.g. for an upload."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+        budget.release(self._reserved)
+        self._reserved = 0
+
+def _download(service, msg_id, part):
+    attachment = Attachment(part['filename'], part['body'].get('size', 0), part['mimeType'])
+    body = part['body']
+    if 'data' in body:
+        attachment.write_base64(body['data'])
+        return attachment
+
+    reserved = budget.acquire(int(attachment.size * BASE64_OVERHEAD)) #* The API returns the whole file as one base64 string
+    try:
+        with service.checkout() as gmail, metrics.timer("gmail_seconds", op="attachment"):
+            att = gmail.users().messages().attachments().get(userId="me", messageId=msg_id, id=body['attachmentId']).execute()
+        attachment.write_base64(att.pop('data'))
+        del att
+    finally:
+        budget.release(reserved)
+    return attachment
+
+def download_all(service, msg_id, parts):
+    """Downloads and decodes all attachment parts concurrently. Failed downloads are skipped."""
+    futures = [_executor.submit(contextvars.copy_context().run, _download, service, msg_id, part) for part in parts] #* Timings count for the calling message
+    attachments = []
+    for part, future in zip(parts, futures):
+        try:
+            attachments.append(future.result())
+        except Exception as e:
+            print(f"Error downloading attachment '{part['filename']}': {e}")
+    return attachments
+
+def inline_attachments(attachments):
+    """The attachments build_parts() sends inline: allowed types until INLINE_LIMIT is reached."""
+    inline = []
+    inline_size = 0
+    for attachment in attachments:
+        if attachment.mimeType in ALLOWED_FILE_TYPES and inline_size + attachment.size <= INLINE_LIMIT:
+            inline_size += attachment.size
+            inline.append(attachment)
+    return inline
+
+def _prepay(attachments, amount): #* Spreads one reservation over the attachments, each close() frees its share
+    for attachment in attachments:
+        share = min(attachment.size, amount)
+        attachment._reserved += share
+        amount -= share
+        attachment._prepaid = True
+
+def reserve_inline(attachments):
+    """Reserves the memory of all inline attachments at once. Reserving them one by one, requests could each hold a part and wait for the rest."""
+    inline = [attachment for attachment in inline_attachments(attachments) if not attachment._prepaid]
+    if inline:
+        _prepay(inline, budget.acquire(sum(attachment.size for attachment in inline)))
+
+async def reserve_inline_async(attachments):
+    """reserve_inline() on the event loop, call it before build_parts() runs in a thread."""
+    inline = [attachment for attachment in inline_attachments(attachments) if not attachment._prepaid]
+    if inline:
+        _prepay(inline, await budget.acquire_async(sum(attachment.size for attachment in inline)))
+
+def build_parts(client, attachments, store=None):
+    """Turns attachments into Gemini content parts.
+
+    Files are sent inline until INLINE_LIMIT is reached, everything else is uploaded through the Files API.
+    With a `store`, an upload of the same content that has not expired yet is reused.
+    """
+    parts = []
+    reserve_inline(attachments) #* No-op after reserve_inline_async()
+    inline = inline_attachments(attachments)
+    for attachment in attachments:
+        if attachment.mimeType not in ALLOWED_FILE_TYPES:
+            continue
+
+        if attachment in inline:
+            parts.append(types.Part.from_bytes(data=attachment.read(), mime_type=attachment.mimeType))
+            continue
+
+        uri = store.uploaded(attachment.sha256) if store else None
+        if uri:
+            parts.append(types.Part.from_uri(file_uri=uri, mime_type=attachment.mimeType))
+            continue
+        uploaded = client.files.upload(file=attachment.stream(), config={"mime_type": attachment.mimeType, "display_name": attachment.name})
+        if store:
+            store.remember_upload(attachment.sha256, uploaded)
+        parts.append(uploaded)
+    return parts
+
+def close_all(attachments):
+    for attachment in attachments or []:
+        attachment.close()
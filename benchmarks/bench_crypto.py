@@ -0,0 +1,87 @@
+#* Benchmark: stored bytes and seal/open throughput of conversation turns, old per-text blobs vs. compressed batch envelopes
+#* Run from the repo root: python -m benchmarks.bench_crypto [turns]
+import os
+import sys
+import time
+import random
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from crypto_utils import Keyring, seal_turn, open_turn, turn_is_current
+
+WORDS = ("the of and to in is that for it as with was on be by this are or an function value return list model answer "
+         "because data example result error python file table should would could which their there about after").split()
+
+def legacy_seal(aesgcm, plaintext): #* Copy of the old implementation: nonce + ciphertext, uncompressed
+    nonce = os.urandom(12)
+    return nonce + aesgcm.encrypt(nonce, plaintext.encode(), None)
+
+def legacy_open(aesgcm, blob):
+    return aesgcm.decrypt(blob[:12], blob[12:], None).decode()
+
+def make_text(rng, chars):
+    lines = []
+    size = 0
+    while size < chars:
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(6, 18))).capitalize() + "."
+        if rng.random() < 0.2:
+            sentence = f"- **{sentence}**"
+        elif rng.random() < 0.1:
+            sentence = f"```python\nresult = compute({rng.randint(1, 999)})\n```"
+        lines.append(sentence)
+        size += len(sentence) + 1
+    return "\n".join(lines)[:chars]
+
+def make_turns(count, seed=7):
+    rng = random.Random(seed)
+    return [(make_text(rng, rng.choice([80, 300, 1200])), make_text(rng, rng.choice([400, 2000, 8000, 30000]))) for _ in range(count)]
+
+def check(turns):
+    old_key, new_key = os.urandom(32), os.urandom(32)
+    old_aesgcm = AESGCM(old_key)
+    rotated = Keyring(new_key, [old_key])
+    for user_text, model_text in turns[:50]:
+        legacy = {"user": legacy_seal(old_aesgcm, user_text), "model": legacy_seal(old_aesgcm, model_text)}
+        assert open_turn(rotated, legacy) == (user_text, model_text) #* Old format, sealed with the rotated out key
+        assert not turn_is_current(rotated, legacy)
+        before = seal_turn(Keyring(old_key), user_text, model_text)
+        assert open_turn(rotated, before) == (user_text, model_text) #* New format, old key id
+        assert not turn_is_current(rotated, before)
+        resealed = seal_turn(rotated, user_text, model_text)
+        assert turn_is_current(rotated, resealed) and open_turn(rotated, resealed) == (user_text, model_text)
+    print("Correctness: old format, old key and key rotation ok")
+
+def bench(turns):
+    key = os.urandom(32)
+    aesgcm = AESGCM(key)
+    keyring = Keyring(key)
+    plaintext = sum(len(u.encode()) + len(m.encode()) for u, m in turns)
+
+    start = time.perf_counter()
+    legacy = [{"user": legacy_seal(aesgcm, u), "model": legacy_seal(aesgcm, m)} for u, m in turns]
+    legacy_seal_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for turn in legacy:
+        legacy_open(aesgcm, turn["user"]), legacy_open(aesgcm, turn["model"])
+    legacy_open_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sealed = [seal_turn(keyring, u, m) for u, m in turns]
+    seal_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for turn in sealed:
+        open_turn(keyring, turn)
+    open_time = time.perf_counter() - start
+
+    legacy_bytes = sum(len(t["user"]) + len(t["model"]) for t in legacy)
+    new_bytes = sum(len(t["turn"]) for t in sealed)
+    count = len(turns)
+    print(f"{count} turns, {plaintext / 1024 / 1024:.1f} MB plaintext")
+    print(f"  Stored:  legacy {legacy_bytes / 1024 / 1024:.2f} MB | envelope {new_bytes / 1024 / 1024:.2f} MB ({new_bytes / legacy_bytes:.0%})")
+    print(f"  Seal:    legacy {count / legacy_seal_time:,.0f} turns/s | envelope {count / seal_time:,.0f} turns/s")
+    print(f"  Open:    legacy {count / legacy_open_time:,.0f} turns/s | envelope {count / open_time:,.0f} turns/s")
+
+if __name__ == '__main__':
+    turns = make_turns(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    check(turns)
+    bench(turns)
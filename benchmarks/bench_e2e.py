@@ -0,0 +1,177 @@
+#* End-to-end benchmark: synthetic mailbox -> main.main()/handle_message() with fake Gmail, Gemini and MongoDB
+#* Run from the repo root: python -m benchmarks.bench_e2e [--messages 300] [--workers 4] [--ai-latency 0.2] [--overload-rate 0.2] [--live 0.5]
+import os
+import sys
+import time
+import base64
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+
+#* The AI client and the key are created on first use, the fake environment only has to exist by then
+_TMP = tempfile.mkdtemp(prefix="email-ai-bench-")
+os.environ.setdefault("gemini_API_key", "offline-benchmark")
+os.environ.setdefault("CHAT_AES_KEY_B64", base64.b64encode(os.urandom(32)).decode())
+os.environ["ASSETS_DIR"] = _TMP
+os.environ["ATTACHMENT_STORE_DIR"] = os.path.join(_TMP, "attachment_store")
+os.environ["OUTBOX_DB_FILE"] = os.path.join(_TMP, "outbox.sqlite3")
+for name in ("top_banner.jpg", "bottom_banner.jpg"): #* Local banner files, so nothing is downloaded
+    with open(os.path.join(_TMP, name), "wb") as f:
+        f.write(os.urandom(8 * 1024))
+
+import main
+import config
+import metrics
+from crypto_utils import seal_turn
+from registry import registry
+from scheduler import Scheduler
+from inbox_sync import InboxSync
+from conversation_store import ConversationStore
+
+from benchmarks.fakes import FakeMailbox, FakeGmailPool, FakeGenai, FakeCollection, make_message
+
+KINDS = {"plain": 0.4, "reply": 0.25, "attachment": 0.2, "unregistered": 0.15} #* Mix of the synthetic mailbox
+STAGES_SHOWN = 12
+
+class Unlimited: #* The benchmark measures the pipeline, not the pacing of the hourly quotas
+    def try_acquire(self, model, plan, cost):
+        return (model, plan, cost), 0
+
+    def acquire(self, model, plan, cost, max_wait=0):
+        return (model, plan, cost)
+
+    def settle(self, reservation, actual):
+        pass
+
+    def remaining(self, model, plan):
+        return {"model": None, "plan": None}
+
+def build_mailbox(mailbox, db, count, history_turns, seed, live=0):
+    """Adds all but the last `live` messages to the mailbox and returns (kinds, the live messages)."""
+    rng = random.Random(seed)
+    users = list(registry.snapshot.users_by_email)
+    blobs = {size: base64.urlsafe_b64encode(os.urandom(size)).decode() for size in (40 * 1024, 400 * 1024, 2 * 1024 * 1024)}
+    kinds = rng.choices(list(KINDS), weights=list(KINDS.values()), k=count)
+    arriving = []
+    question = "Can you explain how the quarterly numbers were calculated and what changed since last month?"
+
+    for i, kind in enumerate(kinds):
+        msg_id = f"m{i:06d}"
+        thread_id = f"t{i:06d}"
+        sender_email = f"someone{i}@unknown.example" if kind == "unregistered" else rng.choice(users)
+        history = None
+        attachments = []
+
+        if kind == "reply": #* Existing conversation in Mongo, the new mail quotes it
+            user = registry.get_user(sender_email)
+            for turn in range(history_turns):
+                db.append(thread_id, user["user_id"], seal_turn(main.keyring, f"{question} ({turn})", "Earlier answer. " * 40))
+            history = "Earlier answer. " * 40
+        elif kind == "attachment":
+            for n in range(rng.randint(1, 2)):
+                size = rng.choice(list(blobs))
+                attachment_id = f"a{i:06d}-{n}"
+                mailbox.attachments[attachment_id] = blobs[size]
+                name, mime_type = rng.choice([("report.pdf", "application/pdf"), ("chart.png", "image/png"), ("data.csv", "text/csv")])
+                attachments.append((name, mime_type, attachment_id, size))
+
+        message = make_message(msg_id, thread_id, sender_email, "Question", question, history=history, attachments=attachments)
+        if i < count - live:
+            mailbox.add(message)
+        else:
+            arriving.append(message)
+    return kinds, arriving
+
+def feed(mailbox, messages, interval): #* Messages arriving while the bot runs, found through the history API
+    for message in messages:
+        time.sleep(interval)
+        mailbox.add(message)
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def run(args):
+    final_labels = {main.LABELS[name]["add"][0]: name for name in ("answered", "broken", "unregistered")}
+    mailbox = FakeMailbox(final_labels, latency=args.gmail_latency)
+    service = FakeGmailPool(mailbox, size=args.workers + 1, batch_window=main.GMAIL_BATCH_WINDOW, batch_size=main.GMAIL_BATCH_SIZE)
+    db = ConversationStore(FakeCollection(latency=args.mongo_latency))
+    genai = FakeGenai(latency=args.ai_latency, overload_rate=args.overload_rate, overloaded_models=[config.DEFAULT_MODEL], seed=args.seed)
+    main.client = genai
+    main.rate_limiter = Unlimited()
+    live = int(args.messages * args.live)
+    kinds, arriving = build_mailbox(mailbox, db, args.messages, args.history_turns, args.seed, live)
+
+    records = []
+    log_record = metrics.log_record
+    def collect(record): #* Keep every per-message record for the percentiles
+        record["total"] = time.perf_counter() - record["start"]
+        records.append(record)
+        log_record(record)
+    metrics.log_record = collect
+
+    scheduler = Scheduler(main.handle_message, workers=args.workers)
+    scheduler.start()
+    main.outbox.start(service, main.ACTIVE_THREADS)
+    sync = InboxSync(service, cursor_file=os.path.join(_TMP, "history_cursor.json"))
+
+    feeder = threading.Thread(target=feed, args=(mailbox, arriving, args.arrival_interval), name="Feeder", daemon=True)
+
+    start = time.perf_counter()
+    feeder.start()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull): #* The bot prints a lot, keep the terminal readable
+        while True:
+            feeding = feeder.is_alive() #* Read before done, the last message may arrive in between
+            if mailbox.done.wait(0.01) and not feeding:
+                break
+            main.main(service, db, scheduler, sync)
+            if time.perf_counter() - start > args.timeout:
+                break
+        elapsed = time.perf_counter() - start
+        while scheduler.in_flight: #* Let the workers finish their last log lines
+            time.sleep(0.01)
+
+    done = len(mailbox.final)
+    by_label = {}
+    for name in mailbox.final.values():
+        by_label[name] = by_label.get(name, 0) + 1
+    by_kind = {kind: kinds.count(kind) for kind in KINDS}
+
+    print(f"Mailbox: {args.messages} messages {by_kind}, {live} of them arriving during the run, {args.workers} worker(s), AI latency {args.ai_latency}s, overload rate {args.overload_rate:.0%} on {config.DEFAULT_MODEL}")
+    print(f"Finished {done}/{args.messages} in {elapsed:.2f}s -> {done / elapsed:.1f} msgs/sec | labels {by_label} | replies sent {len(mailbox.sent)}")
+    print(f"AI calls: {genai.calls} ({genai.overloads} overloaded) | router: { {m: s['state'] for m, s in main.router.stats().items()} }")
+
+    totals = [r["total"] for r in records]
+    stages = {}
+    for record in records:
+        for stage, seconds in record["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    print(f"\n{'stage (per message)':34} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = [("total", totals)] + sorted(stages.items(), key=lambda item: -sum(item[1]))[:STAGES_SHOWN]
+    for stage, values in rows:
+        if values:
+            print(f"{stage:34} {len(values):>6} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}")
+
+    print(f"\nPeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB | threads alive: {threading.active_count()}")
+    return done == args.messages
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the threaded engine.")
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=main.WORKER_COUNT)
+    parser.add_argument("--ai-latency", type=float, default=0.2, help="Seconds per fake Gemini call (+-50%%)")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="Share of calls to the default model that fail as overloaded")
+    parser.add_argument("--gmail-latency", type=float, default=0.01, help="Seconds per fake Gmail request")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="Seconds per fake Mongo operation")
+    parser.add_argument("--history-turns", type=int, default=6, help="Stored turns of every reply thread")
+    parser.add_argument("--live", type=float, default=0.5, help="Share of the messages that arrive while the bot runs (incremental sync)")
+    parser.add_argument("--arrival-interval", type=float, default=0.02, help="Seconds between two arriving messages")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(0 if run(parse_args(sys.argv[1:])) else 1)
@@ -0,0 +1,121 @@
+#* Benchmark: renders/sec of create_email_body() for a short and a 50 KB answer, old f-string version vs. compiled template
+#* Run from the repo root: python -m benchmarks.bench_email_builder [seconds]
+import sys
+import time
+
+import markdown
+
+import email_builder
+
+def legacy_create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id): #* Copy of the old implementation (new Markdown instance + full f-string per call)
+    title = "AI Answer"
+    links = {
+        "GitHub": "https://github.com/KiSki-Dev",
+        "Dashboard": "https://example.com/dashboard",
+        "Discord": "https://discord.gg/cYqpx7dqsn"
+    }
+
+    answer_html = markdown.markdown(answer_md, extensions=['extra', 'sane_lists'])
+    links_html = ' '.join(
+        f'<a href="{url}" style="margin:0 10px; text-decoration:none; color:#38b0fa; font-weight:bold;">{text}</a>'
+        for text, url in links.items()
+    )
+
+    body = (f"""\
+<!DOCTYPE html>
+<html lang="de">
+<head>
+  <meta charset="UTF-8">
+  <title>{title} - Email-AI</title>
+  <style>
+    body {{ margin:0; padding:0; background-color:#f0f9ff; color:#D4D4D4; font-family:'Segoe UI', Tahoma, sans-serif; }}
+    a {{ color:#8ED1FC; }}
+    .banner {{ text-align:center; }}
+    .banner img {{ width:100%; height:100%; max-height: calc(100vw - 50px); border-radius:3px; }}
+    h1 {{ font-size:32px; color:#74c7fb; text-align:center; margin:30px 0 10px; }}
+    .info-row {{ font-size:18px; text-align:center; margin:5px 0; }}
+    .info-row span {{ margin:0 20px; color:#46494a; }}
+    .body-container {{ 
+      background-color:#ebf7fe; 
+      margin:0 20px 15px 20px; 
+      padding:25px; 
+      border-radius:8px; 
+      box-shadow:0 3px 6px rgba(0,0,0,0.5); 
+      font-size:13px; 
+      line-height:1.6; 
+      color:#080808; 
+    }}
+    .message-id {{ font-size:12px; color:#777; text-align:left; margin:0 20px 20px 20px; }}
+    .links-row {{ text-align:center; margin-bottom:30px; }}
+  </style>
+</head>
+<body>
+
+  <!-- Top-Banner -->
+  <div class="banner" style="background:#b4e1fd;">
+    <img src="cid:top_banner" alt="top banner"/>
+  </div>
+
+  <!-- Title -->
+  <h1>{title}</h1>
+
+  <!-- User-Details -->
+  <div class="info-row">
+    <span><strong>Model:</strong> {model}</span>
+    <span><strong>Plan:</strong> {plan}</span>
+  </div>
+
+  <!-- Answer-Details -->
+  <div class="info-row" style="margin-bottom:30px;">
+    <span><strong>Cost of this Answer:</strong> {cost} Tokens</span>
+    <span><strong>Remaining:</strong> {remaining_tokens} Tokens</span>
+  </div>
+
+  <!-- Answer-Body -->
+  <div class="body-container">
+    {answer_html}
+  </div>
+
+  <!-- Message-ID -->
+  <div class="message-id">
+    Message-ID: {message_id}
+  </div>
+
+  <!-- Links -->
+  <div class="links-row">
+    {links_html}
+  </div>
+
+  <!-- Bottom-Banner -->
+  <div class="banner" style="background:#b4e1fd;">
+    <img src="cid:bottom_banner" alt="bottom banner"/>
+  </div>
+
+</body>
+</html>
+""")
+
+    return body
+
+SHORT_ANSWER = "Sure! Here is a **short** answer with a [link](https://example.com).\n\n- one\n- two\n"
+PARAGRAPH = ("## Section\n\nLorem ipsum dolor sit amet, *consectetur* adipiscing elit. "
+             "Integer `code` nec odio. Praesent libero.\n\n1. first\n2. second\n\n"
+             "```python\nprint('hello')\n```\n\n| a | b |\n|---|---|\n| 1 | 2 |\n\n")
+LONG_ANSWER = (PARAGRAPH * (50000 // len(PARAGRAPH) + 1))[:50000]
+
+def renders_per_second(func, answer, seconds):
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        func(answer, "gemini-2.0-flash", "Premium", "1234", 250, "18c2f0a1b2c3d4e5")
+        count += 1
+    return count / seconds
+
+def run(seconds=2.0):
+    for name, answer in (("short", SHORT_ANSWER), ("50 KB", LONG_ANSWER)):
+        old = renders_per_second(legacy_create_email_body, answer, seconds)
+        new = renders_per_second(email_builder.create_email_body, answer, seconds)
+        print(f"[{name}] before: {old:,.0f} renders/s | after: {new:,.0f} renders/s | {new / old:.2f}x")
+
+if __name__ == '__main__':
+    run(float(sys.argv[1]) if len(sys.argv) > 1 else 2.0)
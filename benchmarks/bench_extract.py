@@ -0,0 +1,168 @@
+#* Corpus benchmark: body and quoted-history extraction of parse_message() vs. the old one level parser
+#* Run from the repo root: python -m benchmarks.bench_extract [rounds]
+import re
+import sys
+import time
+import base64
+
+import extracter
+
+QUESTION = "Can you explain how the quarterly numbers were calculated?\nThanks, Anna"
+OLD = "Earlier answer with **markdown**.\n\nSecond paragraph of the earlier answer."
+
+def _b64(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+def text(mime_type, content):
+    return {"mimeType": mime_type, "filename": "", "body": {"data": _b64(content)}}
+
+def multipart(mime_type, *parts):
+    return {"mimeType": mime_type, "filename": "", "body": {"size": 0}, "parts": list(parts)}
+
+def attachment(name, mime_type):
+    return {"mimeType": mime_type, "filename": name, "body": {"attachmentId": f"att-{name}", "size": 1024}}
+
+def message(payload, sender="Anna <anna@example.com>", to="ai@example.com"):
+    headers = [{"name": "Subject", "value": "Question"}, {"name": "From", "value": sender}, {"name": "To", "value": to}, {"name": "Message-ID", "value": "<m1@example.com>"}]
+    return {"id": "m1", "threadId": "t1", "payload": dict(payload, headers=headers)}
+
+def quoted(lines):
+    return "\n".join(f"> {line}" for line in lines.splitlines())
+
+def html(content):
+    return "<div dir=\"ltr\">" + content.replace("\n", "<br>") + "</div>"
+
+GMAIL = f"{QUESTION}\n\nOn Mon, 1 Jan 2024 at 10:00, AI <ai@example.com> wrote:\n\n{quoted(OLD)}\n"
+GMAIL_WRAPPED = f"{QUESTION}\n\nOn Mon, 1 Jan 2024 at 10:00, Email AI Assistant <\nai@example.com> wrote:\n\n{quoted(OLD)}\n"
+GERMAN = f"{QUESTION}\n\nAm Mo., 1. Jan. 2024 um 10:00 Uhr schrieb AI <ai@example.com>:\n\n{quoted(OLD)}\n"
+APPLE = f"{QUESTION}\n\n> On 1 Jan 2024, at 10:00, AI <ai@example.com> wrote:\n> \n{quoted(OLD)}\n"
+APPLE_PLAIN = f"{QUESTION}\n\nOn 1 Jan 2024, at 10:00, AI <ai@example.com> wrote:\n\n{quoted(OLD)}\n"
+OUTLOOK = f"{QUESTION}\n\n________________________________\nFrom: AI <ai@example.com>\nSent: Monday, January 1, 2024 10:00 AM\nTo: Anna <anna@example.com>\nSubject: Re: Question\n\n{OLD}\n"
+OUTLOOK_ORIGINAL = f"{QUESTION}\n\n-----Original Message-----\nFrom: AI <ai@example.com>\nSent: Monday, January 1, 2024 10:00 AM\nSubject: Re: Question\n\n{OLD}\n"
+OTHER_CLIENT = f"{QUESTION}\n\nLe lun. 1 janv. 2024 à 10:00, AI <ai@example.com> a écrit :\n\n{quoted(OLD)}\n"
+GMAIL_HTML = f"<div dir=\"ltr\">{QUESTION.replace(chr(10), '<br>')}</div><br><div class=\"gmail_quote\"><div dir=\"ltr\" class=\"gmail_attr\">On Mon, 1 Jan 2024 at 10:00, AI &lt;ai@example.com&gt; wrote:<br></div><blockquote class=\"gmail_quote\">{OLD}</blockquote></div>"
+NOT_QUOTED_WROTE = "Hi,\n\nOn Ubuntu 22.04 gcc wrote:\n\nmain.c:3:5: error: expected ';' before 'return'\n\nWhat does this mean?" #* Looks like an attribution, is the question
+NOT_QUOTED_HEADERS = "My filter does not match this mail:\n\nFrom: Support Team\nDate: unknown\n\nWhich header is missing?"
+
+#* name -> (message resource, expected body, expected attachment names)
+CORPUS = {
+    "plain, no parts": (message({"mimeType": "text/plain", "filename": "", "body": {"data": _b64(QUESTION)}}), QUESTION, []),
+    "plain in mixed": (message(multipart("multipart/mixed", text("text/plain", QUESTION))), QUESTION, []),
+    "gmail reply": (message(multipart("multipart/alternative", text("text/plain", GMAIL), text("text/html", html(GMAIL)))), QUESTION, []),
+    "gmail reply, wrapped": (message(multipart("multipart/alternative", text("text/plain", GMAIL_WRAPPED), text("text/html", html(GMAIL_WRAPPED)))), QUESTION, []),
+    "gmail reply, german": (message(multipart("multipart/alternative", text("text/plain", GERMAN), text("text/html", html(GERMAN)))), QUESTION, []),
+    "gmail reply + pdf": (message(multipart("multipart/mixed", multipart("multipart/alternative", text("text/plain", GMAIL), text("text/html", html(GMAIL))), attachment("report.pdf", "application/pdf"))), QUESTION, ["report.pdf"]),
+    "apple mail reply": (message(multipart("multipart/alternative", text("text/plain", APPLE_PLAIN), text("text/html", html(APPLE_PLAIN)))), QUESTION, []),
+    "apple mail, quoted marker": (message(multipart("multipart/alternative", text("text/plain", APPLE), text("text/html", html(APPLE)))), QUESTION, []),
+    "outlook reply": (message(multipart("multipart/alternative", text("text/plain", OUTLOOK), text("text/html", html(OUTLOOK)))), QUESTION, []),
+    "outlook original message": (message(text("text/plain", OUTLOOK_ORIGINAL)), QUESTION, []),
+    "other language": (message(multipart("multipart/alternative", text("text/plain", OTHER_CLIENT), text("text/html", html(OTHER_CLIENT)))), QUESTION, []),
+    "mixed > related > alternative": (message(multipart("multipart/mixed",
+        multipart("multipart/related", multipart("multipart/alternative", text("text/plain", GMAIL), text("text/html", html(GMAIL))), attachment("logo.png", "image/png")),
+        attachment("data.csv", "text/csv"), attachment("setup.exe", "application/octet-stream"))), QUESTION, ["logo.png", "data.csv"]),
+    "html only": (message(multipart("multipart/alternative", text("text/html", GMAIL_HTML))), QUESTION, []),
+    "txt attachment": (message(multipart("multipart/mixed", text("text/plain", QUESTION), attachment("notes.txt", "text/plain"))), QUESTION, ["notes.txt"]),
+    "'On ... wrote:' in question": (message(text("text/plain", NOT_QUOTED_WROTE)), NOT_QUOTED_WROTE, []),
+    "'From:/Date:' in question": (message(text("text/plain", NOT_QUOTED_HEADERS)), NOT_QUOTED_HEADERS, [])
+}
+
+def legacy_parse_message(msg): #* Copy of the old get_message_details() without the API calls: attachment parts are collected like parse_message() does, not downloaded
+    payload = msg.get('payload', {})
+    subject = sender = to_email = message_id = ''
+    for header in payload.get('headers', []):
+        if header['name'] == 'Subject':
+            subject = header['value']
+        if header['name'] == 'From':
+            sender = header['value']
+        if header['name'] == 'To':
+            to_email = header['value']
+        if header['name'] == 'Message-ID':
+            message_id = header['value']
+    parts = payload.get('parts', [])
+    body = ''
+    attachment_parts = []
+    if parts:
+        for part in parts:
+            if part['mimeType'] == 'text/plain':
+                body = base64.urlsafe_b64decode(part['body']['data']).decode()
+            elif part['mimeType'] == 'multipart/alternative':
+                try:
+                    for subpart in part.get('parts', []):
+                        if subpart['mimeType'] == 'text/plain':
+                            data = subpart['body']['data']
+                            body = base64.urlsafe_b64decode(data).decode()
+                            body = re.sub(r'<\s*([^\n\r<>]+?)\s*>', lambda m: f"<{m.group(1).strip()}>", body)
+                            from_email_with_arrows = f"<{sender.split('<')[1].split('>')[0]}>"
+                            to_email_with_arrows = f"<{to_email}>"
+                            if (sender.split('<')[1].split('>')[0] and from_email_with_arrows in body) or (to_email and to_email_with_arrows in body):
+                                first = legacy_find_first_substring(from_email_with_arrows, to_email_with_arrows, body)
+                                body = body[:body.index(first) + len(first)]
+                                body = re.compile(rf'^.*{re.escape(first)}.*$', re.MULTILINE).sub('', body)
+                            else:
+                                body = base64.urlsafe_b64decode(data).decode()
+                except Exception:
+                    body = base64.urlsafe_b64decode(part["body"]["data"]).decode()
+            elif part['filename']:
+                if 'data' in part['body'] or part["body"]["size"] < 19900000:
+                    attachment_parts.append(part)
+    else:
+        data = payload.get('body', {}).get('data')
+        if data:
+            body = base64.urlsafe_b64decode(data).decode()
+    thread_id = msg.get('threadId')
+    return subject, sender, body, message_id, thread_id, attachment_parts
+
+def legacy_find_first_substring(a, b, s):
+    index_a = s.find(a)
+    index_b = s.find(b)
+    if index_a == -1:
+        return b
+    if index_b == -1:
+        return a
+    return a if index_a < index_b else b
+
+def check():
+    legacy_ok = []
+    print(f"{'case':32} {'new':>5} {'legacy':>7}")
+    for name, (msg, expected, files) in CORPUS.items():
+        _, _, body, _, _, attachment_parts = extracter.parse_message(msg)
+        new_ok = body.strip() == expected and [p['filename'] for p in attachment_parts] == files
+        try:
+            legacy = legacy_parse_message(msg)[2].strip() == expected
+        except Exception:
+            legacy = False
+        if legacy:
+            legacy_ok.append(msg)
+        print(f"{name:32} {'ok' if new_ok else 'FAIL':>5} {'ok' if legacy else 'wrong':>7}")
+        assert new_ok, (name, body)
+    print(f"Correct bodies: new {len(CORPUS)}/{len(CORPUS)}, legacy {len(legacy_ok)}/{len(CORPUS)}\n")
+    return legacy_ok
+
+def bench(name, messages, rounds):
+    count = rounds * len(messages)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for msg in messages:
+            try:
+                legacy_parse_message(msg)
+            except Exception:
+                pass
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for msg in messages:
+            extracter.parse_message(msg)
+    new_time = time.perf_counter() - start
+
+    print(f"[{name}] {count} messages")
+    print(f"  Legacy: {legacy_time:.3f}s ({count / legacy_time:,.0f} msgs/s)")
+    print(f"  New:    {new_time:.3f}s ({count / new_time:,.0f} msgs/s)")
+    print(f"  Speedup: {legacy_time / new_time:.2f}x")
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    legacy_ok = check()
+    bench("whole corpus", [msg for msg, _, _ in CORPUS.values()], rounds) #* The legacy parser does less here, it misses most quotes
+    bench("cases both get right", legacy_ok, rounds * len(CORPUS) // len(legacy_ok))
@@ -0,0 +1,88 @@
+#* Cold-start benchmark: fresh interpreters importing main and getting ready to poll (AI client, key, Gmail pool)
+#* Run from the repo root: python -m benchmarks.bench_startup [--runs 5] [--max-import SECONDS]
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import subprocess
+import statistics
+
+#* Runs in the child process, prints the timings as JSON
+CHILD = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+if {ready}:
+    from types import SimpleNamespace
+    from gmail_pool import GmailPool
+    main.keyring.resolve()
+    main.client.resolve()
+    pool = GmailPool(SimpleNamespace(valid=True, token="fake"), size=main.GMAIL_POOL_SIZE, token_file="/dev/null")
+ready = time.perf_counter()
+print(json.dumps({{"import": imported - start, "ready": ready - start}}))
+"""
+
+SECRETS = ("gemini_API_key", "CHAT_AES_KEY_B64", "CHAT_AES_OLD_KEYS_B64", "convoDBPass")
+
+def child_env(with_keys):
+    env = {k: v for k, v in os.environ.items() if k not in SECRETS}
+    if with_keys:
+        env["gemini_API_key"] = "offline-benchmark"
+        env["CHAT_AES_KEY_B64"] = base64.b64encode(os.urandom(32)).decode()
+    return env
+
+def run_child(ready, env):
+    result = subprocess.run([sys.executable, "-c", CHILD.format(ready=ready)], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"Child process failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def interpreter_start(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def slowest_imports(env, count=8):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].rstrip()
+            if len(name) - len(name.lstrip()) <= 3: #* Top level imports of main and their direct children only
+                rows.append((int(parts[1]), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+def run(args):
+    bare = [run_child(False, child_env(False)) for _ in range(args.runs)] #* No keys at all: importing must not need them
+    ready = [run_child(True, child_env(True)) for _ in range(args.runs)]
+    import_time = statistics.median(r["import"] for r in bare)
+    ready_time = statistics.median(r["ready"] for r in ready)
+
+    print(f"Cold start, median of {args.runs} fresh interpreters")
+    print(f"  import main (no keys set):         {import_time * 1000:8.1f} ms")
+    print(f"  ready (client, key, Gmail pool):   {ready_time * 1000:8.1f} ms")
+    print(f"  interpreter start (not included):  {interpreter_start(args.runs) * 1000:8.1f} ms")
+    print("\nSlowest imports (cumulative):")
+    for micros, name in slowest_imports(child_env(False)):
+        print(f"  {micros / 1000:8.1f} ms  {name}")
+
+    if args.max_import and import_time > args.max_import: #* Lets CI track regressions
+        print(f"\nImport time {import_time:.3f}s is above the limit of {args.max_import:.3f}s.")
+        return False
+    return True
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Cold-start benchmark.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import", type=float, default=0, help="Fail if `import main` takes longer (seconds)")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(0 if run(parse_args(sys.argv[1:])) else 1)
@@ -0,0 +1,88 @@
+#* Micro-benchmark: compiled SubjectMatcher vs. the old extract_details_from_subject
+#* Run from the repo root: python -m benchmarks.bench_subject_matcher [count]
+import re
+import sys
+import json
+import time
+import random
+
+from subject_matcher import get_matcher
+
+def legacy_extract_details_from_subject(subject, default_model, models): #* Copy of the old implementation
+    s = subject.lower()
+
+    for sep in [",", ";", "_", "/"]:
+        s = s.replace(sep, " ")
+
+    sorted_models = sorted(list(models.keys()), key=lambda m: len(m), reverse=True)
+
+    found_model = None
+    for modell in sorted_models:
+        if modell in s:
+            found_model = modell
+            break
+
+    if not found_model:
+        found_model = default_model
+
+    has_reasoning = bool(re.search(r"\breasoning\b", s))
+    return found_model, has_reasoning
+
+WORDS = ["Question", "about", "my", "homework", "please", "help", "Re:", "Fwd:", "urgent", "code", "review", "invoice", "Hello", "AW:"]
+
+def make_corpus(models, count, seed=42):
+    rnd = random.Random(seed)
+    names = list(models.keys())
+    corpus = []
+    for _ in range(count):
+        words = rnd.choices(WORDS, k=rnd.randint(2, 12))
+        if rnd.random() < 0.6:
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(names).upper() if rnd.random() < 0.2 else rnd.choice(names))
+        if rnd.random() < 0.3:
+            words.append("reasoning")
+        if rnd.random() < 0.2:
+            words.append(f"id-{rnd.randint(1, 99999)}")
+        corpus.append(rnd.choice([" ", ", ", "_", "/", ";"]).join(words))
+    return corpus
+
+def synthetic_models(count):
+    families = ["gemini", "gemma", "claude", "gpt", "llama", "mistral"]
+    sizes = ["flash", "flash-lite", "pro", "ultra", "mini", "nano"]
+    models = {}
+    for i in range(count):
+        name = f"{families[i % len(families)]}-{i // 6 % 4 + 1}.{i % 10}-{sizes[i % len(sizes)]}"
+        models[name] = {"active": True}
+    return models
+
+def bench(name, models, count):
+    default_model = "gemini-2.0-flash"
+    corpus = make_corpus(models, count)
+    matcher = get_matcher(models)
+
+    for subject in corpus: #* Correctness first, both must agree on every subject
+        new = matcher.match(subject, default_model)
+        assert (new["model"], new["reasoning"]) == legacy_extract_details_from_subject(subject, default_model, models), subject
+
+    start = time.perf_counter()
+    for subject in corpus:
+        legacy_extract_details_from_subject(subject, default_model, models)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for subject in corpus:
+        get_matcher(models).match(subject, default_model)
+    new_time = time.perf_counter() - start
+
+    print(f"[{name}] {len(models)} models, {count} subjects")
+    print(f"  Legacy:  {legacy_time:.3f}s ({count / legacy_time:,.0f} subjects/s)")
+    print(f"  Matcher: {new_time:.3f}s ({count / new_time:,.0f} subjects/s)")
+    print(f"  Speedup: {legacy_time / new_time:.2f}x")
+
+def run(count=200000):
+    with open("models.json", encoding="utf-8") as f:
+        models = json.load(f)
+    bench("models.json", models, count)
+    bench("synthetic", synthetic_models(100), count)
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
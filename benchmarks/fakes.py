@@ -0,0 +1,343 @@
+#* In-process stand-ins for Gmail, Gemini and the conversation collection, used by the offline benchmarks
+import os
+import time
+import base64
+import random
+import threading
+from email.parser import BytesHeaderParser
+from types import SimpleNamespace
+
+from google.genai import errors
+
+from gmail_pool import GmailPool
+
+#* ---------------------------------------------------------------- Gmail
+
+class _Request:
+    def __init__(self, func, latency):
+        self.func = func
+        self.latency = latency
+
+    def execute(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.func()
+
+class FakeMailbox:
+    """Shared mailbox state: message resources, their labels, attachments and sent replies."""
+
+    def __init__(self, final_labels, latency=0.01, page_size=100):
+        self.latency = latency
+        self.page_size = page_size
+        self.messages = {} #* id -> message resource
+        self.attachments = {} #* attachmentId -> base64 data
+        self.sent = []
+        self.sent_ids = {} #* Message-ID header -> id of the sent message
+        self.final = {} #* id -> first final label id (answered, broken, unregistered)
+        self.final_labels = final_labels #* label id -> name
+        self.history_id = 1
+        self.history = [] #* (historyId, message id) of every messagesAdded event
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, message):
+        with self._lock:
+            self.messages[message["id"]] = message
+            self.history_id += 1
+            self.history.append((self.history_id, message["id"]))
+            self.done.clear()
+
+    def list_history(self, startHistoryId, labelId=None, pageToken=None, **kwargs):
+        """messagesAdded records after startHistoryId, with the current labels of each message like Gmail returns them."""
+        with self._lock:
+            records = [{"id": str(history_id), "messagesAdded": [{"message": {"id": msg_id, "threadId": self.messages[msg_id]["threadId"], "labelIds": list(self.messages[msg_id]["labelIds"])}}]}
+                       for history_id, msg_id in self.history
+                       if history_id > int(startHistoryId) and (not labelId or labelId in self.messages[msg_id]["labelIds"])]
+            history_id = self.history_id
+        start = int(pageToken or 0)
+        result = {"history": records[start:start + self.page_size], "historyId": history_id}
+        if start + self.page_size < len(records):
+            result["nextPageToken"] = str(start + self.page_size)
+        return result
+
+    def _with_labels(self, label_ids):
+        return [{"id": m["id"], "threadId": m["threadId"]} for m in self.messages.values()
+                if all(label in m["labelIds"] for label in label_ids)]
+
+    def list(self, pageToken=None, q=None, labelIds=None, **kwargs):
+        if q and q.startswith("rfc822msgid:"): #* The outbox looks up replies with unknown outcome
+            sent_id = self.sent_ids.get(q.split(":", 1)[1])
+            return {"messages": [{"id": sent_id}]} if sent_id else {}
+        with self._lock:
+            matching = self._with_labels(labelIds or ["INBOX", "UNREAD"])
+        start = int(pageToken or 0)
+        result = {"messages": matching[start:start + self.page_size]}
+        if start + self.page_size < len(matching):
+            result["nextPageToken"] = str(start + self.page_size)
+        return result
+
+    def get(self, id, **kwargs):
+        return self.messages[id]
+
+    def modify(self, ids, add, remove):
+        with self._lock:
+            for msg_id in ids:
+                labels = self.messages[msg_id]["labelIds"]
+                labels[:] = [l for l in labels if l not in remove] + [l for l in add if l not in labels]
+                for label in add:
+                    if label in self.final_labels and msg_id not in self.final:
+                        self.final[msg_id] = self.final_labels[label]
+            if len(self.final) == len(self.messages):
+                self.done.set()
+        return {}
+
+    def send(self, body):
+        headers = BytesHeaderParser().parsebytes(base64.urlsafe_b64decode(body["raw"]))
+        with self._lock:
+            self.sent.append(len(body["raw"]))
+            sent_id = f"sent-{len(self.sent)}"
+            self.sent_ids[headers["Message-ID"]] = sent_id
+        return {"id": sent_id}
+
+class _Batch:
+    def __init__(self, mailbox, callback):
+        self.mailbox = mailbox
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        time.sleep(self.mailbox.latency) #* One round trip for the whole batch
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.func(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+class FakeGmailResource:
+    """Mimics the parts of the discovery based `service` object the bot uses."""
+
+    _rootDesc = {}
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def _call(self, func):
+        return _Request(func, self.mailbox.latency)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return SimpleNamespace(list=lambda userId, **kwargs: self._call(lambda: self.mailbox.list_history(**kwargs)))
+
+    def attachments(self):
+        return SimpleNamespace(get=lambda userId, messageId, id: self._call(lambda: {"data": self.mailbox.attachments[id]}))
+
+    def getProfile(self, userId):
+        return self._call(lambda: {"historyId": self.mailbox.history_id})
+
+    def list(self, userId, **kwargs):
+        return self._call(lambda: self.mailbox.list(**kwargs))
+
+    def get(self, userId, id, **kwargs):
+        return self._call(lambda: self.mailbox.get(id, **kwargs))
+
+    def modify(self, userId, id, body):
+        return self._call(lambda: self.mailbox.modify([id], body.get("addLabelIds", []), body.get("removeLabelIds", [])))
+
+    def batchModify(self, userId, body):
+        return self._call(lambda: self.mailbox.modify(body["ids"], body.get("addLabelIds", []), body.get("removeLabelIds", [])))
+
+    def send(self, userId, body):
+        return self._call(lambda: self.mailbox.send(body))
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self.mailbox, callback)
+
+class FakeGmailPool(GmailPool):
+    """The real GmailPool (checkout, batching, token handling) on top of FakeGmailResource."""
+
+    def __init__(self, mailbox, size=4, batch_window=0.05, batch_size=50):
+        self.mailbox = mailbox
+        creds = SimpleNamespace(valid=True, token="fake")
+        super().__init__(creds, size=size, token_file=os.devnull, batch_window=batch_window, batch_size=batch_size)
+
+    def _build(self, document=None):
+        return FakeGmailResource(self.mailbox)
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+def make_message(msg_id, thread_id, sender, subject, text, to="ai@example.com", history=None, attachments=()):
+    """Builds a messages.get (format=full) resource like Gmail returns it."""
+    headers = [
+        {"name": "Subject", "value": subject},
+        {"name": "From", "value": f"Sender <{sender}>"},
+        {"name": "To", "value": to},
+        {"name": "Message-ID", "value": f"<{msg_id}@mail.example.com>"}
+    ]
+    if history: #* Reply in the default Gmail format: multipart/alternative with the quoted conversation
+        quoted = f"{text}\n\nOn Mon, 1 Jan 2024 at 10:00, AI <{to}> wrote:\n" + "\n".join(f"> {line}" for line in history.splitlines())
+        parts = [{"mimeType": "multipart/alternative", "filename": "", "body": {"size": 0}, "parts": [
+            {"mimeType": "text/plain", "filename": "", "body": {"data": _b64(quoted.encode())}},
+            {"mimeType": "text/html", "filename": "", "body": {"data": _b64(f"<div>{quoted}</div>".encode())}}
+        ]}]
+    else:
+        parts = [{"mimeType": "text/plain", "filename": "", "body": {"data": _b64(text.encode())}}]
+    for name, mime_type, attachment_id, size in attachments:
+        parts.append({"mimeType": mime_type, "filename": name, "body": {"attachmentId": attachment_id, "size": size}})
+    return {"id": msg_id, "threadId": thread_id, "labelIds": ["INBOX", "UNREAD"], "payload": {"headers": headers, "parts": parts}}
+
+#* ---------------------------------------------------------------- Gemini
+
+STREAM_CHUNKS = 6
+
+class FakeGenai:
+    """Stand-in for genai.Client with a configurable latency and overload rate per model."""
+
+    def __init__(self, latency=0.2, jitter=0.5, overload_rate=0.0, overloaded_models=(), answer_chars=1500, seed=1):
+        self.latency = latency
+        self.jitter = jitter #* Latency varies by +- this fraction
+        self.overload_rate = overload_rate
+        self.overloaded_models = set(overloaded_models)
+        self.answer = ("Here is the **answer** to your question.\n\n- point one\n- point two\n\n" * (answer_chars // 70 + 1))[:answer_chars]
+        self.calls = 0
+        self.overloads = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = SimpleNamespace(generate_content=self._generate, generate_content_stream=self._generate_stream)
+        self.chats = SimpleNamespace(create=self._create_chat)
+        self.files = SimpleNamespace(upload=lambda file, config=None: SimpleNamespace(uri="files/fake", mime_type=(config or {}).get("mime_type")))
+
+    def _respond(self, model, prompt_chars, wait=True):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+            overloaded = model in self.overloaded_models and self._random.random() < self.overload_rate
+            if overloaded:
+                self.overloads += 1
+        if wait:
+            time.sleep(delay)
+        if overloaded:
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "The model is overloaded. Please try again later.", "status": "UNAVAILABLE"}})
+        tokens = prompt_chars // 4 + len(self.answer) // 4
+        return SimpleNamespace(text=self.answer, usage_metadata=SimpleNamespace(total_token_count=tokens), delay=delay)
+
+    def _stream(self, model, prompt_chars, chunks=STREAM_CHUNKS): #* The same answer in chunks, the latency spread over them
+        response = self._respond(model, prompt_chars, wait=False)
+        size = -(-len(self.answer) // chunks)
+        for i in range(chunks):
+            time.sleep(response.delay / chunks)
+            text = self.answer[i * size:(i + 1) * size]
+            tokens = prompt_chars // 4 + (i + 1) * size // 4
+            yield SimpleNamespace(text=text, candidates=None, usage_metadata=SimpleNamespace(prompt_token_count=prompt_chars // 4, total_token_count=tokens))
+
+    def _generate(self, model, contents, config=None):
+        return self._respond(model, _prompt_chars(contents))
+
+    def _generate_stream(self, model, contents, config=None):
+        return self._stream(model, _prompt_chars(contents))
+
+    def _create_chat(self, model, history=None, config=None):
+        history_chars = sum(len(c.parts[0].text or "") for c in history or [])
+        return SimpleNamespace(send_message=lambda question: self._respond(model, history_chars + _prompt_chars(question)),
+                               send_message_stream=lambda question: self._stream(model, history_chars + _prompt_chars(question)))
+
+def _prompt_chars(contents):
+    return len(contents if isinstance(contents, str) else " ".join(c for c in contents if isinstance(c, str)))
+
+#* ---------------------------------------------------------------- MongoDB
+
+def _matches(doc, query):
+    for key, expected in query.items():
+        value = doc.get(key)
+        if isinstance(expected, dict) and "$in" in expected:
+            if value not in expected["$in"]:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+class FakeCollection:
+    """Just enough of a pymongo collection for ConversationStore (find_one, the window aggregate, update_one/many)."""
+
+    def __init__(self, latency=0.002):
+        self.latency = latency
+        self.docs = {} #* threadID -> document
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_index(self, *args, **kwargs):
+        return kwargs.get("name")
+
+    def _find(self, query):
+        for doc in self.docs.values():
+            if _matches(doc, query):
+                return doc
+        return None
+
+    def find_one(self, query, projection=None):
+        self._wait()
+        with self._lock:
+            doc = self._find(query)
+            if doc is None:
+                return None
+            doc = dict(doc, history=list(doc.get("history", [])))
+        if projection and "$slice" in projection.get("history", {}):
+            doc["history"] = doc["history"][projection["history"]["$slice"]:]
+        return doc
+
+    def aggregate(self, pipeline):
+        self._wait()
+        match = pipeline[0]["$match"]
+        last_k = pipeline[1]["$project"]["history"]["$slice"][1]
+        with self._lock:
+            doc = self._find(match)
+            if doc is None:
+                return iter([])
+            history = doc.get("history", [])
+            result = {"_id": doc["threadID"], "summary": doc.get("summary"), "summarized_turns": doc.get("summarized_turns"),
+                      "attachments": doc.get("attachments"), "turn_count": len(history), "history": list(history[last_k:])}
+        return iter([{k: v for k, v in result.items() if v is not None}])
+
+    def _apply(self, doc, update, inserted):
+        for key, value in update.get("$set", {}).items():
+            doc[key] = value
+        for key, value in update.get("$push", {}).items():
+            doc.setdefault(key, []).append(value)
+        for key, value in update.get("$addToSet", {}).items():
+            items = doc.setdefault(key, [])
+            items.extend(v for v in value["$each"] if v not in items)
+        if inserted:
+            doc.update(update.get("$setOnInsert", {}))
+
+    def update_one(self, query, update, upsert=False):
+        self._wait()
+        with self._lock:
+            doc = self._find(query)
+            if doc is None:
+                if not upsert:
+                    return SimpleNamespace(modified_count=0, upserted_id=None)
+                doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+                self.docs[doc["threadID"]] = doc
+                self._apply(doc, update, True)
+                return SimpleNamespace(modified_count=0, upserted_id=doc["threadID"])
+            self._apply(doc, update, False)
+            return SimpleNamespace(modified_count=1, upserted_id=None)
+
+    def update_many(self, query, update):
+        self._wait()
+        with self._lock:
+            docs = [doc for doc in self.docs.values() if _matches(doc, query)]
+            for doc in docs:
+                self._apply(doc, update, False)
+        return SimpleNamespace(modified_count=len(docs))
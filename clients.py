@@ -0,0 +1,38 @@
+import os
+import threading
+import importlib
+
+import crypto_utils
+
+class Lazy:
+    """Creates the wrapped object on first use and then behaves like it.
+
+    Importing a module that holds one needs no API key, AES key or network,
+    call `resolve()` at startup to fail early instead.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, name): #* Only called for attributes Lazy itself does not have
+        return getattr(self.resolve(), name)
+
+def _create_client():
+    from google import genai #* Slow import, only needed once the first question is asked
+    return genai.Client(api_key=os.getenv('gemini_API_key'))
+
+client = Lazy(_create_client)
+keyring = Lazy(crypto_utils.load_aes_key) #* Current key plus old keys that can still decrypt
+
+#* google.genai.types takes most of the import time of the bot, the modules that need it load it on first use
+genai_types = Lazy(lambda: importlib.import_module("google.genai.types"))
+genai_errors = Lazy(lambda: importlib.import_module("google.genai.errors"))
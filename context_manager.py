@@ -0,0 +1,154 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from clients import genai_types as types
+from crypto_utils import seal
+from history_cache import history_cache
+from registry import registry
+from rate_limiter import rate_limiter, estimate_cost
+from engine_common import router
+
+HISTORY_TURNS = int(os.getenv("CONTEXT_HISTORY_TURNS", "10")) #* Max. turns replayed verbatim
+FOLD_BATCH = max(HISTORY_TURNS // 2, 1) #* Extra turns folded per summary call, so not every new turn needs one
+LOAD_TURNS = HISTORY_TURNS * 3 #* Turns read from Mongo on a cache miss, leaves room for folds that are still running
+DEFAULT_TOKEN_BUDGET = 32000 #* When a model has no "history_token_budget" in models.json
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and an AI assistant.
+Keep all facts, decisions, names, numbers, code references and open questions. Write it in the language of the conversation.
+Return only the updated summary.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}"""
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="Summarizer")
+
+def estimate_tokens(text): #* Rough estimate (~4 characters per token), good enough for budgeting
+    return len(text) // 4 + 1
+
+def token_budget(model):
+    return registry.models.get(model, {}).get("history_token_budget", DEFAULT_TOKEN_BUDGET)
+
+def _turn_texts(conversation):
+    contents = conversation.contents
+    return [(contents[i].parts[0].text, contents[i + 1].parts[0].text) for i in range(0, len(contents), 2)]
+
+def fitting_turns(conversation, model):
+    """Number of most recent turns that fit into HISTORY_TURNS and the model's token budget."""
+    budget = token_budget(model) - estimate_tokens(conversation.summary or "")
+    turns = _turn_texts(conversation)
+    used = 0
+    count = 0
+    for user_text, model_text in reversed(turns[-HISTORY_TURNS:]):
+        used += estimate_tokens(user_text) + estimate_tokens(model_text)
+        if used > budget:
+            break
+        count += 1
+    return count
+
+def build_context(conversation, model):
+    """Returns (history, config) for client.chats.create(). Older turns are only present as the summary."""
+    keep = fitting_turns(conversation, model)
+    history = conversation.contents[len(conversation.contents) - keep * 2:] if keep else []
+    config = None
+    if conversation.summary:
+        config = types.GenerateContentConfig(system_instruction=f"Summary of the earlier conversation in this email thread:\n{conversation.summary}")
+    return history, config
+
+def _summary_request(conversation, folded):
+    messages = "\n\n".join(f"User: {user_text}\nAI: {model_text}" for user_text, model_text in _turn_texts(conversation)[:folded])
+    return SUMMARY_PROMPT.format(summary=conversation.summary or "(none)", messages=messages)
+
+def _plan_fold(thread_id, model):
+    conversation = history_cache.get(thread_id)
+    if conversation is None:
+        return None, 0
+    turns = len(conversation.contents) // 2
+    folded = turns - fitting_turns(conversation, model)
+    if folded > 0:
+        folded = min(folded + FOLD_BATCH, turns - 1) #* Always keep the newest turn verbatim
+    return conversation, folded
+
+def fold(client, db, keyring, thread_id, model, summary_model, plan=None):
+    """Folds all turns that no longer fit into the context into the stored, encrypted rolling summary.
+
+    Only the previous summary and the newly dropped turns are sent to the AI, so the cost does not grow with the thread.
+    The call goes through the router and the rate limiter like an answer and counts against the user's plan.
+    """
+    conversation, folded = _plan_fold(thread_id, model)
+    if folded <= 0:
+        return
+    request = _summary_request(conversation, folded)
+    def reserve(model): #* A RetryLater (rate limited, no healthy model) skips this fold, the next turn tries again
+        return rate_limiter.acquire(model, plan, estimate_cost(request, None))
+
+    def ask(model, reservation):
+        try:
+            response = client.models.generate_content(model=model, contents=request)
+        except Exception:
+            rate_limiter.settle(reservation, 0)
+            raise
+        rate_limiter.settle(reservation, response.usage_metadata.total_token_count if response.usage_metadata else 0)
+        return response
+
+    _, response = router.ask(summary_model, ask, reserve)
+    if not response.text:
+        return
+    summarized = conversation.first + folded #* Absolute, the loaded turns may start after the old summary
+    if db.set_summary(thread_id, conversation.summarized, summarized, seal(keyring, response.text)):
+        history_cache.fold(thread_id, response.text, summarized, folded)
+        print(f"Folded {folded} turn(s) of thread {thread_id} into the summary ({summarized} total).")
+
+async def fold_async(client, db, keyring, thread_id, model, summary_model, plan=None):
+    conversation, folded = _plan_fold(thread_id, model)
+    if folded <= 0:
+        return
+    request = _summary_request(conversation, folded)
+    async def reserve(model):
+        while True:
+            reservation, wait = rate_limiter.try_acquire(model, plan, estimate_cost(request, None))
+            if reservation:
+                return reservation
+            await asyncio.sleep(wait)
+
+    async def ask(model, reservation):
+        try:
+            response = await client.aio.models.generate_content(model=model, contents=request)
+        except Exception:
+            rate_limiter.settle(reservation, 0)
+            raise
+        rate_limiter.settle(reservation, response.usage_metadata.total_token_count if response.usage_metadata else 0)
+        return response
+
+    _, response = await router.ask_async(summary_model, ask, reserve)
+    if not response.text:
+        return
+    summarized = conversation.first + folded
+    if await db.set_summary(thread_id, conversation.summarized, summarized, seal(keyring, response.text)):
+        history_cache.fold(thread_id, response.text, summarized, folded)
+        print(f"Folded {folded} turn(s) of thread {thread_id} into the summary ({summarized} total).")
+
+_background_tasks = set()
+
+def schedule_fold_async(client, db, keyring, thread_id, model, summary_model, plan=None):
+    """Same as schedule_fold(), as a task on the running event loop."""
+    async def run():
+        try:
+            await fold_async(client, db, keyring, thread_id, model, summary_model, plan)
+        except Exception as e:
+            print(f"Error while summarizing thread {thread_id}: {e}")
+    task = asyncio.create_task(run())
+    _background_tasks.add(task) #* Keep a reference, otherwise the task can be garbage collected
+    task.add_done_callback(_background_tasks.discard)
+
+def schedule_fold(client, db, keyring, thread_id, model, summary_model, plan=None):
+    """Runs fold() in the background, the reply does not wait for the summary."""
+    def run():
+        try:
+            fold(client, db, keyring, thread_id, model, summary_model, plan)
+        except Exception as e:
+            print(f"Error while summarizing thread {thread_id}: {e}")
+    _executor.submit(run)
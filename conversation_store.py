@@ -0,0 +1,174 @@
+import time
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+from metrics import metrics
+
+EXPIRE_DAYS = 7
+EXPIRY_FLUSH_INTERVAL = 60 #* Seconds between batched expireAt updates
+
+class ConversationStore:
+    """Conversation storage on top of the `conversations` collection.
+
+    New turns are appended with an atomic $push (no read-modify-write of the
+    whole history), so two racing turns can not overwrite each other.
+    Expiry bumps are collected and written with one update_many per interval.
+    """
+
+    def __init__(self, collection, expire_days=EXPIRE_DAYS, flush_interval=EXPIRY_FLUSH_INTERVAL):
+        self.collection = collection
+        self.expire_days = expire_days
+        self.flush_interval = flush_interval
+        self._touched = set()
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.collection.create_index([("threadID", pymongo.ASCENDING)], unique=True, name="threadID_unique")
+        self.collection.create_index([("expireAt", pymongo.ASCENDING)], expireAfterSeconds=0, name="expireAt_ttl") #* Mongo deletes the document at expireAt
+        print("MongoDB indexes ensured.")
+
+    def start_expiry_flusher(self):
+        def flush_loop():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush_expiry()
+                except Exception as e:
+                    print(f"Error while updating conversation expiry: {e}")
+        threading.Thread(target=flush_loop, name="ExpiryFlusher", daemon=True).start()
+
+    def _expire_at(self):
+        return datetime.now() + timedelta(days=self.expire_days)
+
+    def load(self, thread_id, last_k=None):
+        """Returns the conversation document, or None. With `last_k` only the last K turns are read from Mongo."""
+        projection = {"history": {"$slice": -last_k}} if last_k else None
+        with metrics.timer("mongo_seconds", op="read"):
+            return self.collection.find_one({"threadID": thread_id}, projection)
+
+    def _window_pipeline(self, thread_id, last_k):
+        return [
+            {"$match": {"threadID": thread_id}},
+            {"$project": {
+                "summary": 1,
+                "summarized_turns": 1,
+                "attachments": 1,
+                "turn_count": {"$size": "$history"},
+                "history": {"$slice": ["$history", -last_k]}
+            }}
+        ]
+
+    def load_window(self, thread_id, last_k):
+        """Returns summary, summarized_turns, the total turn_count and only the last K turns, in one round trip."""
+        with metrics.timer("mongo_seconds", op="read"):
+            return next(self.collection.aggregate(self._window_pipeline(thread_id, last_k)), None)
+
+    def _summary_filter(self, thread_id, summarized):
+        #* Only update if nobody else folded in the meantime (missing field = 0)
+        return {"threadID": thread_id, "summarized_turns": summarized if summarized else {"$in": [None, 0]}}
+
+    def set_summary(self, thread_id, old_summarized, new_summarized, sealed_summary):
+        with metrics.timer("mongo_seconds", op="write"):
+            result = self.collection.update_one(self._summary_filter(thread_id, old_summarized), {"$set": {"summary": sealed_summary, "summarized_turns": new_summarized}})
+        return result.modified_count == 1
+
+    def _migration(self, thread_id, turns, summary):
+        query = {"threadID": thread_id}
+        update = {}
+        for index, (old, new) in turns.items(): #* Only replaced if the entry is still the one that was read
+            query[f"history.{index}"] = old
+            update[f"history.{index}"] = new
+        if summary:
+            query["summary"], update["summary"] = summary
+        return query, {"$set": update}
+
+    def migrate(self, thread_id, turns, summary=None):
+        """Writes resealed history entries ({index: (old, new)}) and summary ((old, new)) in one update."""
+        with metrics.timer("mongo_seconds", op="write"):
+            result = self.collection.update_one(*self._migration(thread_id, turns, summary))
+        return result.modified_count == 1
+
+    def _append_update(self, user_id, turn, attachments):
+        update = {
+            "$push": {"history": turn},
+            "$setOnInsert": {"user_id": user_id, "expireAt": self._expire_at()}
+        }
+        if attachments: #* References into the attachment store, the files themselves are not in Mongo
+            update["$addToSet"] = {"attachments": {"$each": attachments}}
+        return update
+
+    def append(self, thread_id, user_id, turn, attachments=None):
+        """Appends one turn ({"turn": sealed batch}, see crypto_utils.seal_turn()) and creates the conversation if it does not exist yet."""
+        update = self._append_update(user_id, turn, attachments)
+        with metrics.timer("mongo_seconds", op="write"):
+            try:
+                self.collection.update_one({"threadID": thread_id}, update, upsert=True)
+            except DuplicateKeyError: #* Two upserts raced on a new thread, the document exists now
+                self.collection.update_one({"threadID": thread_id}, update)
+        self.touch(thread_id)
+
+    def touch(self, thread_id):
+        with self._lock:
+            self._touched.add(thread_id)
+
+    def flush_expiry(self):
+        with self._lock:
+            touched, self._touched = list(self._touched), set()
+        if touched:
+            self.collection.update_many({"threadID": {"$in": touched}}, {"$set": {"expireAt": self._expire_at()}})
+
+class AsyncConversationStore(ConversationStore):
+    """Same storage layout as ConversationStore, on top of a motor (asyncio) collection."""
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("threadID", pymongo.ASCENDING)], unique=True, name="threadID_unique")
+        await self.collection.create_index([("expireAt", pymongo.ASCENDING)], expireAfterSeconds=0, name="expireAt_ttl")
+        print("MongoDB indexes ensured.")
+
+    async def run_expiry_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_expiry()
+            except Exception as e:
+                print(f"Error while updating conversation expiry: {e}")
+
+    async def load(self, thread_id, last_k=None):
+        projection = {"history": {"$slice": -last_k}} if last_k else None
+        with metrics.timer("mongo_seconds", op="read"):
+            return await self.collection.find_one({"threadID": thread_id}, projection)
+
+    async def load_window(self, thread_id, last_k):
+        with metrics.timer("mongo_seconds", op="read"):
+            async for doc in self.collection.aggregate(self._window_pipeline(thread_id, last_k)):
+                return doc
+        return None
+
+    async def set_summary(self, thread_id, old_summarized, new_summarized, sealed_summary):
+        with metrics.timer("mongo_seconds", op="write"):
+            result = await self.collection.update_one(self._summary_filter(thread_id, old_summarized), {"$set": {"summary": sealed_summary, "summarized_turns": new_summarized}})
+        return result.modified_count == 1
+
+    async def migrate(self, thread_id, turns, summary=None):
+        with metrics.timer("mongo_seconds", op="write"):
+            result = await self.collection.update_one(*self._migration(thread_id, turns, summary))
+        return result.modified_count == 1
+
+    async def append(self, thread_id, user_id, turn, attachments=None):
+        update = self._append_update(user_id, turn, attachments)
+        with metrics.timer("mongo_seconds", op="write"):
+            try:
+                await self.collection.update_one({"threadID": thread_id}, update, upsert=True)
+            except DuplicateKeyError:
+                await self.collection.update_one({"threadID": thread_id}, update)
+        self.touch(thread_id)
+
+    async def flush_expiry(self):
+        with self._lock:
+            touched, self._touched = list(self._touched), set()
+        if touched:
+            await self.collection.update_many({"threadID": {"$in": touched}}, {"$set": {"expireAt": self._expire_at()}})
@@ -1,19 +1,122 @@
-import os, base64, sys
+import os, base64, sys, json, zlib, hashlib
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+from metrics import metrics
+
+#* Envelope: MAGIC | key id (4) | flags (1) | nonce (12) | ciphertext. The header is authenticated as associated data.
+#* Blobs without the MAGIC prefix are the old format (nonce + ciphertext of the plain UTF-8 text).
+MAGIC = b"EA\x01" #* Format version 1
+KEY_ID_SIZE = 4
+HEADER_SIZE = len(MAGIC) + KEY_ID_SIZE + 1
+COMPRESSED = 0x01 #* Plaintext is zlib compressed
+BATCH = 0x02 #* Plaintext is a JSON list of strings
+COMPRESS_MIN = int(os.getenv("CRYPTO_COMPRESS_MIN", "256")) #* Shorter texts are stored uncompressed, zlib would only add bytes
+COMPRESS_LEVEL = 6
+LAZY_MIGRATION = os.getenv("CRYPTO_LAZY_MIGRATION", "1") == "1" #* Reseal old format/old key entries when a conversation is loaded
+
+def key_id(key):
+    return hashlib.sha256(key).digest()[:KEY_ID_SIZE] #* Identifies the key without revealing it
+
+class Keyring:
+    """The current AES-256-GCM key for sealing plus older keys that can still open what they sealed.
+
+    Rotating CHAT_AES_KEY_B64: move the old key to CHAT_AES_OLD_KEYS_B64 (comma separated),
+    old conversations stay readable and are resealed with the new key when they are loaded.
+    """
+
+    def __init__(self, key, old_keys=()):
+        self.primary_id = key_id(key)
+        self.primary = AESGCM(key)
+        self._keys = {key_id(k): AESGCM(k) for k in old_keys}
+        self._keys[self.primary_id] = self.primary
+
+    def get(self, kid):
+        return self._keys.get(kid)
+
+    def legacy_candidates(self): #* Old format blobs carry no key id, the current key is tried first
+        return [self.primary] + [aesgcm for kid, aesgcm in self._keys.items() if kid != self.primary_id]
+
 def load_aes_key():
     b64 = os.getenv("CHAT_AES_KEY_B64")
     if not b64:
         sys.exit("CHAT_AES_KEY_B64 environment variable not set.")
-    AES_KEY = base64.b64decode(b64) #* 32 raw bytes
-    aesgcm = AESGCM(AES_KEY)
-    return aesgcm
+    key = base64.b64decode(b64) #* 32 raw bytes
+    old_keys = [base64.b64decode(k) for k in os.getenv("CHAT_AES_OLD_KEYS_B64", "").split(",") if k.strip()]
+    return Keyring(key, old_keys)
 
-def seal(aesgcm, plaintext: str) -> bytes: #! Encrypts a plaintext and returns nonce+ciphertext
-    nonce = os.urandom(12) #* 96‑Bit    
-    ct = aesgcm.encrypt(nonce, plaintext.encode(), None)
-    return nonce + ct
+def _seal_bytes(keyring, data, flags, compress=True):
+    if compress and len(data) >= COMPRESS_MIN:
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(packed) < len(data):
+            data = packed
+            flags |= COMPRESSED
+    header = MAGIC + keyring.primary_id + bytes([flags])
+    nonce = os.urandom(12) #* 96‑Bit
+    with metrics.timer("crypto_seconds", op="encrypt"):
+        ct = keyring.primary.encrypt(nonce, data, header)
+    return header + nonce + ct
 
-def open_sealed(aesgcm, blob: bytes) -> str: #! Decrypts a nonce+ciphertext blob back into a string
+def _open_bytes(keyring, blob):
+    """Returns (plaintext bytes, flags). Falls back to the old format if the blob has no valid envelope."""
+    blob = bytes(blob) #* pymongo returns bson.Binary
+    if blob.startswith(MAGIC) and len(blob) > HEADER_SIZE + 12:
+        header = blob[:HEADER_SIZE]
+        aesgcm = keyring.get(header[len(MAGIC):-1])
+        if aesgcm is not None:
+            nonce, ct = blob[HEADER_SIZE:HEADER_SIZE + 12], blob[HEADER_SIZE + 12:]
+            try:
+                with metrics.timer("crypto_seconds", op="decrypt"):
+                    data = aesgcm.decrypt(nonce, ct, header)
+                flags = header[-1]
+                return (zlib.decompress(data) if flags & COMPRESSED else data), flags
+            except InvalidTag: #? An old format nonce that happens to start with MAGIC
+                pass
     nonce, ct = blob[:12], blob[12:]
-    return aesgcm.decrypt(nonce, ct, None).decode()
\ No newline at end of file
+    for aesgcm in keyring.legacy_candidates():
+        try:
+            with metrics.timer("crypto_seconds", op="decrypt"):
+                return aesgcm.decrypt(nonce, ct, None), 0
+        except InvalidTag:
+            continue
+    raise InvalidTag("No key in the keyring can open this blob.")
+
+def seal(keyring, plaintext: str) -> bytes: #! Compresses (if it helps) and encrypts a plaintext into an envelope
+    return _seal_bytes(keyring, plaintext.encode(), 0)
+
+def open_sealed(keyring, blob: bytes) -> str: #! Decrypts an envelope (or an old nonce+ciphertext blob) back into a string
+    return _open_bytes(keyring, blob)[0].decode()
+
+def seal_bytes(keyring, data: bytes, compress=True) -> bytes: #* Binary content (attachments), compression is pointless for PDFs and images
+    return _seal_bytes(keyring, data, 0, compress)
+
+def open_bytes(keyring, blob: bytes) -> bytes:
+    return _open_bytes(keyring, blob)[0]
+
+def seal_batch(keyring, texts) -> bytes:
+    """Seals several texts as one envelope: one nonce, one tag and one compression window for all of them."""
+    return _seal_bytes(keyring, json.dumps(list(texts), ensure_ascii=False).encode(), BATCH)
+
+def open_batch(keyring, blob: bytes) -> list:
+    data, flags = _open_bytes(keyring, blob)
+    if not flags & BATCH:
+        raise ValueError("Blob is not a sealed batch.")
+    return json.loads(data)
+
+def is_current(keyring, blob) -> bool:
+    """True if the blob is an envelope sealed with the current key (nothing to migrate)."""
+    blob = bytes(blob)
+    return blob.startswith(MAGIC) and blob[len(MAGIC):HEADER_SIZE - 1] == keyring.primary_id
+
+def seal_turn(keyring, user_text, model_text): #* One stored history entry
+    return {"turn": seal_batch(keyring, [user_text, model_text])}
+
+def open_turn(keyring, turn):
+    """Returns (user_text, model_text) of a history entry, in the batch format or the old {"user", "model"} format."""
+    if "turn" in turn:
+        user_text, model_text = open_batch(keyring, turn["turn"])
+        return user_text, model_text
+    return open_sealed(keyring, turn["user"]), open_sealed(keyring, turn["model"])
+
+def turn_is_current(keyring, turn):
+    return "turn" in turn and is_current(keyring, turn["turn"])
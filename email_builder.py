@@ -1,34 +1,38 @@
+import re
+import html
+import threading
+
 import markdown
 
-def create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id):
-    title = "AI Answer"
-    links = {
-        "GitHub": "https://github.com/KiSki-Dev",
-        "Dashboard": "https://example.com/dashboard",
-        "Discord": "https://discord.gg/cYqpx7dqsn"
-    }
+TITLE = "AI Answer"
+LINKS = {
+    "GitHub": "https://github.com/KiSki-Dev",
+    "Dashboard": "https://example.com/dashboard",
+    "Discord": "https://discord.gg/cYqpx7dqsn"
+}
 
-    answer_html = markdown.markdown(answer_md, extensions=['extra', 'sane_lists'])
-    links_html = ' '.join(
-        f'<a href="{url}" style="margin:0 10px; text-decoration:none; color:#38b0fa; font-weight:bold;">{text}</a>'
-        for text, url in links.items()
-    )
+LINKS_HTML = ' '.join(
+    f'<a href="{url}" style="margin:0 10px; text-decoration:none; color:#38b0fa; font-weight:bold;">{text}</a>'
+    for text, url in LINKS.items()
+)
+LINKS_TEXT = "\n".join(f"{text}: {url}" for text, url in LINKS.items())
 
-    body = (f"""\
+#* $name fields are filled in by create_email_body(), everything else is static
+TEMPLATE = """\
 <!DOCTYPE html>
 <html lang="de">
 <head>
   <meta charset="UTF-8">
-  <title>{title} - Email-AI</title>
+  <title>$title - Email-AI</title>
   <style>
-    body {{ margin:0; padding:0; background-color:#f0f9ff; color:#D4D4D4; font-family:'Segoe UI', Tahoma, sans-serif; }}
-    a {{ color:#8ED1FC; }}
-    .banner {{ text-align:center; }}
-    .banner img {{ width:100%; height:100%; max-height: calc(100vw - 50px); border-radius:3px; }}
-    h1 {{ font-size:32px; color:#74c7fb; text-align:center; margin:30px 0 10px; }}
-    .info-row {{ font-size:18px; text-align:center; margin:5px 0; }}
-    .info-row span {{ margin:0 20px; color:#46494a; }}
-    .body-container {{ 
+    body { margin:0; padding:0; background-color:#f0f9ff; color:#D4D4D4; font-family:'Segoe UI', Tahoma, sans-serif; }
+    a { color:#8ED1FC; }
+    .banner { text-align:center; }
+    .banner img { width:100%; height:100%; max-height: calc(100vw - 50px); border-radius:3px; }
+    h1 { font-size:32px; color:#74c7fb; text-align:center; margin:30px 0 10px; }
+    .info-row { font-size:18px; text-align:center; margin:5px 0; }
+    .info-row span { margin:0 20px; color:#46494a; }
+    .body-container { 
       background-color:#ebf7fe; 
       margin:0 20px 15px 20px; 
       padding:25px; 
@@ -37,9 +41,9 @@ def create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id
       font-size:13px; 
       line-height:1.6; 
       color:#080808; 
-    }}
-    .message-id {{ font-size:12px; color:#777; text-align:left; margin:0 20px 20px 20px; }}
-    .links-row {{ text-align:center; margin-bottom:30px; }}
+    }
+    .message-id { font-size:12px; color:#777; text-align:left; margin:0 20px 20px 20px; }
+    .links-row { text-align:center; margin-bottom:30px; }
   </style>
 </head>
 <body>
@@ -50,33 +54,33 @@ def create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id
   </div>
 
   <!-- Title -->
-  <h1>{title}</h1>
+  <h1>$title</h1>
 
   <!-- User-Details -->
   <div class="info-row">
-    <span><strong>Model:</strong> {model}</span>
-    <span><strong>Plan:</strong> {plan}</span>
+    <span><strong>Model:</strong> $model</span>
+    <span><strong>Plan:</strong> $plan</span>
   </div>
 
   <!-- Answer-Details -->
   <div class="info-row" style="margin-bottom:30px;">
-    <span><strong>Cost of this Answer:</strong> {cost} Tokens</span>
-    <span><strong>Remaining:</strong> {remaining_tokens} Tokens</span>
+    <span><strong>Cost of this Answer:</strong> $cost Tokens</span>
+    <span><strong>Remaining:</strong> $remaining_tokens Tokens</span>
   </div>
 
   <!-- Answer-Body -->
   <div class="body-container">
-    {answer_html}
+    $answer_html
   </div>
 
   <!-- Message-ID -->
   <div class="message-id">
-    Message-ID: {message_id}
+    Message-ID: $message_id
   </div>
 
   <!-- Links -->
   <div class="links-row">
-    {links_html}
+    $links_html
   </div>
 
   <!-- Bottom-Banner -->
@@ -86,6 +90,43 @@ def create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id
 
 </body>
 </html>
-""")
+"""
+
+def _compile(template, static):
+    """Turns the template into a str.format() string once. Static fields are filled in right away."""
+    escaped = template.replace("{", "{{").replace("}", "}}") #* CSS braces
+    def field(m):
+        name = m.group(1)
+        if name in static:
+            return static[name].replace("{", "{{").replace("}", "}}")
+        return "{" + name + "}"
+    return re.sub(r"\$(\w+)", field, escaped)
 
-    return body
\ No newline at end of file
+_COMPILED = _compile(TEMPLATE, {"title": TITLE, "links_html": LINKS_HTML})
+_local = threading.local()
+
+def render_markdown(answer_md):
+    md = getattr(_local, "md", None)
+    if md is None: #* One Markdown instance per thread, building it (and its extensions) is the expensive part
+        md = _local.md = markdown.Markdown(extensions=['extra', 'sane_lists'])
+    return md.reset().convert(answer_md)
+
+def create_email_body(answer_md, model, plan, cost, remaining_tokens, message_id):
+    return _COMPILED.format(
+        answer_html=render_markdown(answer_md),
+        model=html.escape(str(model)),
+        plan=html.escape(str(plan)),
+        cost=html.escape(str(cost)),
+        remaining_tokens=html.escape(str(remaining_tokens)),
+        message_id=html.escape(str(message_id))
+    )
+
+def create_plain_body(answer_md, model, plan, cost, remaining_tokens, message_id): #* text/plain alternative, the answer stays plain markdown
+    return (
+        f"{TITLE}\n\n"
+        f"Model: {model} | Plan: {plan}\n"
+        f"Cost of this Answer: {cost} Tokens | Remaining: {remaining_tokens} Tokens\n\n"
+        f"{answer_md}\n\n"
+        f"Message-ID: {message_id}\n\n"
+        f"{LINKS_TEXT}\n"
+    )
@@ -0,0 +1,90 @@
+#* State and helpers shared by the threaded engine (main.py) and the async engine (async_engine.py).
+#* Kept out of main.py: with ENGINE=async, main runs as __main__ and importing it again would create a second copy of everything.
+import time
+
+from config import LABELS, DEFAULT_MODEL, DEFAULT_BACKUP_MODEL, RECLAIM_INTERVAL
+import extracter
+from thread_queue import ThreadQueue, job_messages
+from gmail_labels import OPEN_LABELS
+from registry import registry
+from history_cache import history_cache
+from model_router import ModelRouter
+from metrics import metrics
+
+#* Threads with a running turn, plus the messages held for them. With leases, another instance may have
+#* appended turns since this one cached the conversation, so the cached copy is dropped.
+ACTIVE_THREADS = ThreadQueue(on_lease=history_cache.invalidate)
+
+router = ModelRouter(fallback=DEFAULT_BACKUP_MODEL)
+
+last_reclaim = 0
+
+def reclaim_stuck(service):
+    """Messages with the "progressing" label that nobody works on, e.g. after a crash. At most every RECLAIM_INTERVAL.
+
+    Messages of threads leased by another (running) instance are filtered later by the lease itself.
+    """
+    global last_reclaim
+    if time.monotonic() - last_reclaim < RECLAIM_INTERVAL:
+        return []
+    last_reclaim = time.monotonic()
+
+    messages = []
+    page_token = None
+    while True:
+        with service.checkout() as gmail, metrics.timer("gmail_seconds", op="list"):
+            results = gmail.users().messages().list(userId='me', labelIds=LABELS["progressing"]["add"], pageToken=page_token).execute()
+        messages.extend(results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    stuck = [dict(m, reclaimed=True) for m in messages if m['threadId'] not in ACTIVE_THREADS]
+    if stuck:
+        print(f"Found {len(stuck)} message(s) stuck in progressing.")
+    return stuck
+
+def still_open(service, message):
+    """Ids of the job's messages that are not finished yet. Others were answered in the meantime.
+
+    Reclaimed messages may have been finished by their old owner. With leases, any message may have
+    been answered by the instance that held the lease when this one listed it, so all of them are checked.
+    """
+    msg_ids = [m['id'] for m in job_messages(message)]
+    check = msg_ids if ACTIVE_THREADS.leases else [m['id'] for m in job_messages(message) if m.get("reclaimed")]
+    futures = {msg_id: service.get_message(msg_id, format='minimal') for msg_id in check} #* Submitted together, so they share one batch
+    done = {msg_id for msg_id, future in futures.items() if not OPEN_LABELS.intersection(future.result().get('labelIds', []))}
+    return [msg_id for msg_id in msg_ids if msg_id not in done]
+
+def resolve_request(to):
+    """Finds user, model and plan for a sender. "error" is None, "inactive", "unregistered" or "broken"."""
+    snapshot = registry.snapshot #* One consistent view of users and models for the whole message
+    user = snapshot.users_by_email.get(to.lower())
+    if not user:
+        default_model = DEFAULT_MODEL
+    else:
+        default_model = user["model"]
+
+    models = snapshot.models
+
+    model, use_reasoning = extracter.extract_details_from_subject(to, default_model, models)
+    request = {"user": user, "model": model, "reasoning": use_reasoning, "error": None,
+               "plan": user["plan"] if user else "Unregistered",
+               "tokens": user["tokens"] if user else 420}
+
+    if models[model]["active"] == False:
+        request["error"] = "inactive"
+    elif models[model]["perm_level_required"] != 0:
+        if not user:
+            request["error"] = "unregistered"
+        elif models[model]["perm_level_required"] > get_perm_level(user["plan"]):
+            request["error"] = "broken"
+
+    #! input_tokens = count_tokens(body, model)
+    return request
+
+def get_perm_level(plan):
+    if plan == "Premium": 
+        return 1
+    elif plan == "Developer":
+        return 2
+    return 0
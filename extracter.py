@@ -1,138 +1,206 @@
-import base64
 import re
-import threading #* Needed for gmail_lock
-from locker import gmail_lock
+import binascii
+from html import unescape
+
+from attachments import download_all, ALLOWED_FILE_TYPES
+from registry import registry
+from subject_matcher import get_matcher
+from metrics import metrics
 
 def get_message_details(service, msg_id):
-    with gmail_lock:
-        msg = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+    with metrics.timer("gmail_seconds", op="get"): #* Includes the batching window
+        msg = service.get_message(msg_id, format='full').result()
+    subject, sender, body, message_id, thread_id, attachment_parts = parse_message(msg)
+    attachments = download_all(service, msg_id, attachment_parts) #* Concurrent, decoded into spooled temp files
+    return subject, sender, body, message_id, thread_id, attachments
+
+def merge_details(details): #* Several messages of one thread as one question: bodies in order, headers of the newest message
+    subject, sender, _, message_id, thread_id, _ = details[-1]
+    body = "\n\n".join(d[2] for d in details if d[2])
+    attachments = [attachment for d in details for attachment in d[5]]
+    return subject, sender, body, message_id, thread_id, attachments
+
+def parse_message(msg): #* Reads headers, body and attachment parts of a full message resource, without any API calls
     payload = msg.get('payload', {})
-    headers = payload.get('headers', [])
     subject = ''
     sender = ''
     to_email = ''
     message_id = ''
-    for header in headers:
-        if header['name'] == 'Subject':
+    for header in payload.get('headers', []):
+        name = header['name']
+        if name == 'Subject':
             subject = header['value']
-        if header['name'] == 'From':
+        elif name == 'From':
             sender = header['value']
-        if header['name'] == 'To':
+        elif name == 'To':
             to_email = header['value']
-        if header['name'] == 'Message-ID':
+        elif name == 'Message-ID':
             message_id = header['value']
-    parts = payload.get('parts', [])
+
+    plain, html, attachment_parts = walk_parts(payload)
     body = ''
-    attachments = []
-
-    if parts:
-        for part in parts:
-            if part['mimeType'] == 'text/plain':
-                data = part['body']['data']
-                body = base64.urlsafe_b64decode(data).decode()
-
-            elif part['mimeType'] == 'multipart/alternative': #* When email is a reply and it has the default gmail reply format
-                try:
-                    subparts = part.get('parts', [])
-                    if subparts:
-                        for subpart in subparts:
-                            if subpart['mimeType'] == 'text/plain':
-                                data = subpart['body']['data']
-                                body = base64.urlsafe_b64decode(data).decode()
-                                body = re.sub(r'<\s*([^\n\r<>]+?)\s*>', lambda m: f"<{m.group(1).strip()}>", body) #* Remove whitespace inside angle brackets
-        
-                                from_email_with_arrows = f"<{sender.split('<')[1].split('>')[0]}>"
-                                to_email_with_arrows = f"<{to_email}>"
-
-                                is_email_with_history = (sender.split('<')[1].split('>')[0] and from_email_with_arrows in body) or (to_email and to_email_with_arrows in body)
-
-                                if is_email_with_history:
-                                    history_email_with_arrows = find_first_substring(from_email_with_arrows, to_email_with_arrows, body)
-                                    body = body[:body.index(history_email_with_arrows) + len(history_email_with_arrows)]
-                                    from_regexp = re.compile(rf'^.*{re.escape(history_email_with_arrows)}.*$', re.MULTILINE)
-                                    body = from_regexp.sub('', body)
-                                else:
-                                    body = base64.urlsafe_b64decode(data).decode()
-
-                except Exception as e:
-                    print(f"Error processing multipart/alternative: {e}")
-                    data = part["body"]["data"]
-                    body = base64.urlsafe_b64decode(data).decode()
-
-            elif part['filename']:
-                if 'data' in part['body']:
-                    data = part['body']['data']
-                else:
-                    if part["body"]["size"] < 19900000: #* If the attachment is smaller than 19,90 MB
-                        att_id = part['body']['attachmentId']
-                        with gmail_lock:
-                            att = service.users().messages().attachments().get(userId="me", messageId=msg_id,id=att_id).execute()
-                        data = att['data']
-                    else:
-                        #ToDo: Implement Files API
-                        break
-
-                file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
-
-                attachment = {
-                    "name": part['filename'],
-                    "size": part['body']['size'],
-                    "mimeType": part['mimeType'],
-                    "data": file_data
-                }
-                attachments.append(attachment)
-
-    else:
-        data = payload.get('body', {}).get('data')
-        if data:
-            body = base64.urlsafe_b64decode(data).decode()
+    try:
+        if plain is not None:
+            body = strip_quoted(decode_part(plain), (sender, to_email))
+        elif html is not None: #* HTML only mails (some mobile clients)
+            body = strip_quoted(html_to_text(decode_part(html)), (sender, to_email))
+    except Exception as e:
+        print(f"Error while extracting the body: {e}")
 
     thread_id = msg.get('threadId')
-    return subject, sender, body, message_id, thread_id, attachments
-
-def find_first_substring(a, b, s):
-    index_a = s.find(a)
-    index_b = s.find(b)
-
-    if index_a == -1:
-        return b
-    if index_b == -1:
-        return a
-
-    return a if index_a < index_b else b
-
-
-def extract_details_from_subject(subject, default_model, models):
-    s = subject.lower()
-
-    for sep in [",", ";", "_", "/"]: #* Replace common separators with a space
-        s = s.replace(sep, " ")
-
-    sorted_models = sorted(list(models.keys()), key=lambda m: len(m), reverse=True) #* Sort models by length to match longer names first
-
-    found_model = None
-    for modell in sorted_models:
-        if modell in s:
-            found_model = modell
-            break
-
-    if not found_model:
-        found_model = default_model #* If no model found, set to default
-
-    #* Check for Parameters in subject
-    has_reasoning = bool(re.search(r"\breasoning\b", s))
+    return subject, sender, body, message_id, thread_id, attachment_parts
+
+def walk_parts(payload):
+    """One pass over the MIME tree (any depth, e.g. mixed -> related -> alternative).
+
+    Returns the first text/plain part, the first text/html part and the attachment parts to download.
+    Nothing is decoded here.
+    """
+    if 'parts' not in payload and not payload.get('filename'): #* Single part mail, the common case
+        mime_type = payload.get('mimeType')
+        if mime_type in ('text/plain', 'text/html') and payload.get('body', {}).get('data'):
+            return (payload, None, []) if mime_type == 'text/plain' else (None, payload, [])
+        return None, None, []
+    found = [None, None, []]
+    _walk(payload.get('parts') or [payload], found)
+    return tuple(found)
+
+def _walk(parts, found): #* Recursion is cheaper than an explicit stack here, MIME trees are only a few levels deep
+    for part in parts:
+        children = part.get('parts')
+        if children:
+            _walk(children, found)
+        elif part.get('filename'):
+            if part.get('mimeType') in ALLOWED_FILE_TYPES: #* Dont download files the AI cant read anyway
+                found[2].append(part)
+        else:
+            mime_type = part.get('mimeType')
+            if mime_type == 'text/plain':
+                if found[0] is None and part.get('body', {}).get('data'):
+                    found[0] = part
+            elif mime_type == 'text/html':
+                if found[1] is None and part.get('body', {}).get('data'):
+                    found[1] = part
+
+URLSAFE = bytes.maketrans(b'-_', b'+/')
+
+def decode_part(part): #* Same as base64.urlsafe_b64decode(), without its Python level wrappers
+    return binascii.a2b_base64(part['body']['data'].encode('ascii').translate(URLSAFE)).decode('utf-8', 'replace')
+
+def address(value): #* "Name <a@b.com>" -> "a@b.com"
+    if '<' in value:
+        return value.split('<')[1].split('>')[0].strip()
+    return value.strip()
+
+#* Where the quoted history of a reply starts, compiled once
+ANGLE_SPACES = re.compile(r'<\s*([^\n\r<>]+?)\s*>') #* Gmail wraps long lines inside "<\nname@example.com>"
+ANGLE_GAPS = re.compile(r'<(?:\s|[^\n\r<>]*\s+>)') #* Found wherever ANGLE_SPACES would change something, much cheaper than sub()
+QUOTE_SEPARATORS = re.compile("|".join([ #* Unambiguous, cut wherever they appear
+    r'^[ \t]*-{2,}[ \t]*(?:Original Message|Ursprüngliche Nachricht)[ \t]*-{2,}', #* Outlook (plain text)
+    r'^[ \t]*_{10,}[ \t]*\n[ \t]*\*?(?:From|Von):' #* Outlook: separator line and header block
+]), re.MULTILINE)
+ATTRIBUTIONS = re.compile("|".join([ #* Can also be part of a question, see is_attribution()
+    r'^[ \t]*On\b[^\n]*(?:\n[^\n]*)?\bwrote:[ \t]*$', #* Gmail and Apple Mail: "On Mon, 1 Jan 2024 at 10:00, Name <a@b.com> wrote:" (may be wrapped once)
+    r'^[ \t]*Am\b[^\n]*(?:\n[^\n]*)?\bschrieb\b[^\n]*:[ \t]*$', #* German Gmail and Apple Mail: "Am 01.01.2024 um 10:00 schrieb Name <a@b.com>:"
+    r'^[ \t]*\*?(?:From|Von):\*?[ \t][^\n]*\n[ \t]*\*?(?:Sent|Gesendet|Date|Datum):[^\n]*' #* Outlook header block without separator
+]), re.MULTILINE)
+ATTRIBUTION_HINTS = ("wrote:", "schrieb", "From:", "Von:") #* Every ATTRIBUTIONS match has one on its first line, or on its second one if wrapped
+WRAPPED_HINTS = ("wrote:", "schrieb")
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+#* A time, 01.01.2024, 2024-01-01, 1/1/24 or a year. Starts with an ASCII digit (the word boundary is the lookbehind), re skips ahead to a plain character set much faster than to \d
+DATE = re.compile(r'[0-9](?<!\w\d)(?:\d?:\d{2}|\d?\.\s?\d{1,2}\.\s?\d{2,4}|\d{0,3}[/-]\d{1,2}[/-]\d{1,4}|(?<=1)9\d{2}|(?<=2)0\d{2})\b')
+QUOTED_NEXT = re.compile(r'(?:[ \t]*\n)+[ \t]*>') #* The next non-empty line is quoted
+HTML_QUOTES = re.compile(r'<(?:div|blockquote)[^>]*(?:class="[^"]*(?:gmail_quote|gmail_attr)[^"]*"|type="cite"|id="(?:appendonsend|divRplyFwdMsg)")', re.IGNORECASE)
+HTML_BREAKS = re.compile(r'<\s*(?:br|/p|/div|/li|/tr|/h[1-6])\b[^>]*>', re.IGNORECASE)
+HTML_DROP = re.compile(r'<(style|script|head)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+HTML_TAGS = re.compile(r'<[^>]+>')
+BLANK_LINES = re.compile(r'\n[ \t]*\n(?:[ \t]*\n)+')
+
+def is_attribution(body, match):
+    """A real attribution line names an address or a date, or quoted lines follow it ("On Ubuntu 22.04 gcc wrote:" does neither)."""
+    text = match.group(0)
+    return bool(QUOTED_NEXT.match(body, match.end()) or ('@' in text and EMAIL.search(text)) or DATE.search(text))
+
+def find_attribution(body, cut):
+    """Start of the first real attribution before `cut`, or `cut`.
+
+    ATTRIBUTIONS is only matched at the line of a hint and the line before it (wrapped attributions),
+    scanning the whole body with it is several times slower than the rest of parse_message().
+    """
+    starts = []
+    for hint in ATTRIBUTION_HINTS:
+        index = body.find(hint, 0, cut) if hint in body else -1 #* Usually only one of them is there, "in" is cheaper than find()
+        while index != -1:
+            line = body.rfind("\n", 0, index) + 1
+            if hint in WRAPPED_HINTS and line > 1 and body[line - 2] != "\n": #* A blank line cant start an attribution
+                starts.append(body.rfind("\n", 0, line - 1) + 1)
+            starts.append(line)
+            index = body.find(hint, index + len(hint), cut)
+    starts.sort()
+    tried = -1 #* Starts up to here were matched already or lie inside a rejected match, finditer() would skip them too
+    for start in starts:
+        if start > tried:
+            tried = start
+            match = ATTRIBUTIONS.match(body, start, cut)
+            if match:
+                if is_attribution(body, match):
+                    return start
+                tried = match.end()
+    return cut
+
+def strip_quoted(body, headers=()):
+    """Cuts the quoted conversation off a reply. The history is stored in MongoDB, so only the new text is needed.
+
+    `headers` are the From and To values, lines naming one of their addresses can also start the quote.
+    """
+    angles = '<' in body
+    if angles and ANGLE_GAPS.search(body):
+        body = ANGLE_SPACES.sub(r'<\1>', body)
+    cut = len(body)
+    if "Original Message" in body or "Ursprüngliche Nachricht" in body or "__________" in body: #* Every QUOTE_SEPARATORS match has one
+        match = QUOTE_SEPARATORS.search(body)
+        if match:
+            cut = match.start()
+    if ':' in body: #* Attribution lines and the address lines below all have one, most new mails dont
+        if "wrote:" in body or "schrieb" in body or "From:" in body or "Von:" in body: #* ATTRIBUTION_HINTS, chained "in" is the cheapest check
+            if '@' in body or '>' in body or DATE.search(body): #* is_attribution() accepts nothing without one of them
+                cut = find_attribution(body, cut)
+        for email in map(address, headers) if angles and body.find('<', 0, cut) != -1 else (): #* Attribution lines of other clients and languages still name one of the two addresses
+            index = body.find(f"<{email}>", 0, cut) if email else -1
+            if index != -1:
+                line_end = body.find("\n", index)
+                line = body[body.rfind("\n", 0, index) + 1:line_end if line_end != -1 else len(body)]
+                if line.rstrip().endswith(":"):
+                    cut = body.rfind("\n", 0, index) + 1
+    if cut == len(body):
+        return body
+    return body[:cut].rstrip()
+
+def html_to_text(html):
+    quote = HTML_QUOTES.search(html)
+    if quote:
+        html = html[:quote.start()]
+    html = HTML_DROP.sub('', html)
+    text = unescape(HTML_TAGS.sub('', HTML_BREAKS.sub('\n', html)))
+    return BLANK_LINES.sub('\n\n', text).strip()
+
+def request_sender(service, msg_id): #* Cheap metadata only request, used to prioritize messages before the full fetch. Returns a Future
+    return service.get_message(msg_id, format='metadata', metadataHeaders=['From'])
+
+def sender_of(msg): #* Address from the metadata of request_sender()
+    for header in msg.get('payload', {}).get('headers', []):
+        if header['name'] == 'From':
+            value = header['value']
+            return value.split('<')[1].split('>')[0] if '<' in value else value.strip()
+    return ''
 
-    #* Check for ID in subject.
-    #ToDo: Implement IDs/Context Chache
-    # match_id = re.search(r"\bid-(\d+)\b", s)
-    # extracted_id = match_id.group(1) if match_id else None
 
-    #? Maybe implement? only for debugging
-    # temp = s.replace(found_model, " ")
-    # if match_id:
-    #     temp = temp.replace(match_id.group(0), " ")
-    # temp = re.sub(r"\breasoning\b", " ", temp)
-    # temp = re.sub(r"\s+", " ", temp).strip()
-    # rest_tokens = temp.split() if temp else []
+def parse_subject(subject, default_model, models=None):
+    """Returns a dict with the model and all recognised parameters (reasoning, flags, thread IDs)."""
+    if models is None:
+        models = registry.models
+    return get_matcher(models).match(subject, default_model) #* Compiled once per models.json version
 
-    return found_model, has_reasoning
\ No newline at end of file
+def extract_details_from_subject(subject, default_model, models=None):
+    details = parse_subject(subject, default_model, models)
+    return details["model"], details["reasoning"]
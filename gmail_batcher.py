@@ -0,0 +1,106 @@
+import threading
+from concurrent.futures import Future
+
+BATCH_MODIFY_LIMIT = 1000 #* Max IDs per messages.batchModify call
+BATCH_REQUEST_LIMIT = 50 #* Gmail recommends max. 50 requests per batch HTTP request
+
+class GmailBatcher:
+    """Collects label changes and message fetches from all workers and sends them together.
+
+    Items are flushed after `window` seconds or as soon as `max_size` items are pending.
+    Every call returns a Future, so the caller gets its own result (or exception) back.
+    Label changes with the same add/remove set are merged into one messages.batchModify,
+    fetches are sent as one batch HTTP request.
+    """
+
+    def __init__(self, pool, window=0.05, max_size=50):
+        self.pool = pool
+        self.window = window
+        self.max_size = max_size
+        self._modifies = []
+        self._fetches = []
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name="GmailBatcher", daemon=True).start()
+
+    def modify(self, msg_id, add, remove):
+        future = Future()
+        with self._cond:
+            self._modifies.append((msg_id, tuple(add), tuple(remove), future))
+            self._cond.notify()
+        return future
+
+    def get(self, msg_id, **kwargs):
+        future = Future()
+        with self._cond:
+            self._fetches.append((msg_id, kwargs, future))
+            self._cond.notify()
+        return future
+
+    def _pending(self):
+        return len(self._modifies) + len(self._fetches)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending():
+                    self._cond.wait()
+                self._cond.wait_for(lambda: self._pending() >= self.max_size, timeout=self.window) #* Collect more items for a short time
+                modifies, self._modifies = self._modifies, []
+                fetches, self._fetches = self._fetches, []
+
+            try:
+                if modifies:
+                    self._flush_modifies(modifies)
+                if fetches:
+                    self._flush_fetches(fetches)
+            except Exception as e: #! Never let the flush thread die, fail the open futures instead
+                for item in modifies + fetches:
+                    if not item[-1].done():
+                        item[-1].set_exception(e)
+
+    def _flush_modifies(self, items):
+        groups = {}
+        for msg_id, add, remove, future in items:
+            groups.setdefault((add, remove), []).append((msg_id, future))
+
+        for (add, remove), entries in groups.items():
+            for i in range(0, len(entries), BATCH_MODIFY_LIMIT):
+                chunk = entries[i:i + BATCH_MODIFY_LIMIT]
+                body = {'ids': [msg_id for msg_id, _ in chunk], 'addLabelIds': list(add), 'removeLabelIds': list(remove)}
+                try:
+                    with self.pool.checkout() as gmail:
+                        gmail.users().messages().batchModify(userId='me', body=body).execute()
+                    for _, future in chunk:
+                        future.set_result(True)
+                except Exception as e:
+                    print(f"batchModify for {len(chunk)} message(s) failed: {e}. Retrying one by one.")
+                    self._modify_single(chunk, add, remove) #* batchModify is all or nothing, find out which IDs really fail
+
+    def _modify_single(self, entries, add, remove):
+        body = {'addLabelIds': list(add), 'removeLabelIds': list(remove)}
+        for msg_id, future in entries:
+            try:
+                with self.pool.checkout() as gmail:
+                    gmail.users().messages().modify(userId='me', id=msg_id, body=body).execute()
+                future.set_result(True)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _flush_fetches(self, items):
+        for i in range(0, len(items), BATCH_REQUEST_LIMIT):
+            chunk = items[i:i + BATCH_REQUEST_LIMIT]
+            futures = {}
+
+            def callback(request_id, response, exception):
+                future = futures[request_id]
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(response)
+
+            with self.pool.checkout() as gmail:
+                batch = gmail.new_batch_http_request(callback=callback)
+                for n, (msg_id, kwargs, future) in enumerate(chunk):
+                    futures[str(n)] = future
+                    batch.add(gmail.users().messages().get(userId='me', id=msg_id, **kwargs), request_id=str(n))
+                batch.execute()
@@ -0,0 +1,19 @@
+from config import LABELS
+from metrics import metrics, annotate
+
+OPEN_LABELS = {"UNREAD", LABELS["progressing"]["add"][0]} #* A message without both is finished
+
+def label_name(label):
+    return next((name for name, value in LABELS.items() if value is label), "other")
+
+def mark_label(service, msg_id, label):
+    mark_labels(service, [msg_id], label)
+
+def mark_labels(service, msg_ids, label):
+    name = label_name(label)
+    with metrics.timer("gmail_seconds", op="modify"):
+        futures = [service.modify(msg_id, label["add"], label["remove"]) for msg_id in msg_ids] #* Batched with the label changes of the other workers
+        for future in futures:
+            future.result()
+    metrics.inc("labels_total", len(msg_ids), label=name)
+    annotate(label=name)
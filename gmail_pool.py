@@ -0,0 +1,110 @@
+import os
+import json
+import queue
+from contextlib import contextmanager
+
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import Request
+from googleapiclient.discovery import build, build_from_document
+
+from locker import token_lock
+from metrics import metrics
+from gmail_batcher import GmailBatcher
+
+TOKEN_FILE = 'token.json'
+DISCOVERY_FILE = os.getenv("GMAIL_DISCOVERY_FILE", "gmail_discovery.json") #* Local copy of the Gmail API description
+
+_discovery = None
+
+def discovery_document(path=DISCOVERY_FILE):
+    """The parsed Gmail discovery document, read once per process.
+
+    Comes from the local copy, else from the copy bundled with google-api-python-client.
+    Only very old versions of the library have to download it; it is then saved as the local copy.
+    """
+    global _discovery
+    if _discovery is not None:
+        return _discovery
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            _discovery = json.load(f)
+        return _discovery
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc('gmail', 'v1')
+    except ImportError:
+        content = None
+    if content:
+        _discovery = json.loads(content)
+    else:
+        _discovery = build('gmail', 'v1', http=httplib2.Http())._rootDesc
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(_discovery, f)
+    return _discovery
+
+class GmailPool:
+    """Pool of independent Gmail service objects sharing one set of credentials.
+
+    httplib2 is not thread safe, so every service gets its own Http instance.
+    Use `checkout()` to borrow one for a request:
+
+        with pool.checkout() as service:
+            service.users().messages().get(...).execute()
+
+    Label changes and message fetches should go through `modify()` / `get_message()`,
+    they are batched across all workers.
+    """
+
+    def __init__(self, creds, size=4, token_file=TOKEN_FILE, batch_window=0.05, batch_size=50):
+        self.creds = creds
+        self.size = size
+        self.token_file = token_file
+        self._services = queue.LifoQueue() #* LIFO keeps the most recently used (warm) connections busy
+
+        document = discovery_document() #* Parsed once, building a service from the dict is cheap
+        for _ in range(size):
+            self._services.put(self._build(document))
+
+        self.batcher = GmailBatcher(self, window=batch_window, max_size=batch_size)
+
+    def _build(self, document):
+        http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+        return build_from_document(document, http=http)
+
+    def ensure_token(self):
+        if self.creds.valid:
+            return
+        with metrics.timer("lock_wait_seconds", lock="token"):
+            token_lock.acquire()
+        try: #* Only one thread refreshes, the others wait and reuse the new token
+            if self.creds.valid:
+                return
+            self.creds.refresh(Request())
+            with open(self.token_file, 'w') as token:
+                token.write(self.creds.to_json())
+            print("Gmail token refreshed.")
+        finally:
+            token_lock.release()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        self.ensure_token()
+        with metrics.timer("lock_wait_seconds", lock="gmail_pool"): #* Time spent waiting for a free client
+            service = self._services.get(timeout=timeout)
+        try:
+            yield service
+        finally:
+            self._services.put(service)
+
+    def modify(self, msg_id, add, remove):
+        """Queues a label change. Returns a Future that resolves to True or raises the Gmail error."""
+        return self.batcher.modify(msg_id, add, remove)
+
+    def get_message(self, msg_id, **kwargs):
+        """Queues a messages.get. Returns a Future that resolves to the message resource."""
+        return self.batcher.get(msg_id, **kwargs)
+
+    @property
+    def available(self):
+        return self._services.qsize()
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from clients import genai_types as types
+
+MAX_BYTES = int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024))) #* Max. plaintext kept in memory
+TTL = int(os.getenv("HISTORY_CACHE_TTL", "900")) #* Seconds until an entry is dropped, even if it is used
+
+def to_contents(user_text, model_text):
+    return [
+        types.Content(role="user", parts=[types.Part(text=user_text)]),
+        types.Content(role="model", parts=[types.Part(text=model_text)])
+    ]
+
+class Conversation:
+    """Decrypted state of a thread: rolling summary of older turns plus the recent turns as types.Content."""
+
+    def __init__(self, contents, summary=None, summarized=0, attachments=None, first=None):
+        self.contents = contents #* 2 entries (user, model) per turn
+        self.summary = summary
+        self.summarized = summarized #* Number of turns folded into the summary
+        self.first = summarized if first is None else first #* Absolute index of the turn in contents[0]
+        self.attachments = attachments or [] #* References into the attachment store, sent again with every turn
+
+    def copy(self):
+        return Conversation(list(self.contents), self.summary, self.summarized, list(self.attachments), self.first)
+
+    def size(self):
+        return len(self.summary or "") + sum(len(c.parts[0].text or "") for c in self.contents)
+
+class HistoryCache:
+    """LRU cache of decrypted conversations per threadID.
+
+    Bounded by the plaintext size of all entries and by a TTL, so decrypted
+    conversations do not stay in memory longer than needed.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict() #* thread_id -> [conversation, size, expires_at]
+        self._lock = threading.Lock()
+
+    def get(self, thread_id):
+        """Returns a copy of the cached conversation or None."""
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(thread_id)
+                return None
+            self._entries.move_to_end(thread_id)
+            return entry[0].copy()
+
+    def put(self, thread_id, conversation):
+        size = conversation.size()
+        with self._lock:
+            if thread_id in self._entries:
+                self._remove(thread_id)
+            if size > self.max_bytes:
+                return
+            self._entries[thread_id] = [conversation.copy(), size, time.monotonic() + self.ttl]
+            self.size += size
+            self._evict()
+
+    def append(self, thread_id, user_text, model_text, attachments=()):
+        """Adds a new turn (and the references of its new attachments) to a cached conversation. Does nothing if the thread is not cached."""
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is None:
+                return
+            added = len(user_text) + len(model_text)
+            entry[0].contents.extend(to_contents(user_text, model_text))
+            entry[0].attachments.extend(attachments)
+            entry[1] += added
+            self.size += added
+            self._entries.move_to_end(thread_id)
+            self._evict()
+
+    def fold(self, thread_id, summary, summarized, folded_turns):
+        """Replaces the oldest `folded_turns` turns of a cached conversation with the new summary."""
+        with self._lock:
+            entry = self._entries.get(thread_id)
+            if entry is None or entry[0].first + folded_turns != summarized:
+                return #* Not cached or changed in the meantime
+            conversation = entry[0]
+            conversation.contents = conversation.contents[folded_turns * 2:]
+            conversation.first = summarized
+            conversation.summary = summary
+            conversation.summarized = summarized
+            new_size = conversation.size()
+            self.size += new_size - entry[1]
+            entry[1] = new_size
+
+    def invalidate(self, thread_id):
+        with self._lock:
+            if thread_id in self._entries:
+                self._remove(thread_id)
+
+    def _remove(self, thread_id):
+        _, size, _ = self._entries.pop(thread_id)
+        self.size -= size
+
+    def _evict(self):
+        now = time.monotonic()
+        for thread_id in [t for t, entry in self._entries.items() if entry[2] < now]:
+            self._remove(thread_id)
+        while self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries))) #* Least recently used first
+
+history_cache = HistoryCache()
@@ -0,0 +1,187 @@
+import os
+import json
+import base64
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from googleapiclient.errors import HttpError
+
+from metrics import metrics
+
+HISTORY_CURSOR_FILE = "history_cursor.json"
+SEEN_CACHE_SIZE = 5000 #* How many message IDs are remembered to skip duplicates between bootstrap and history
+
+class InboxSync:
+    """Incremental inbox reader built on the Gmail history API.
+
+    The last seen historyId is stored on disk. Every sync only asks Gmail for
+    `messageAdded` events after that cursor and pages through all of them, so
+    there is no per-poll cap anymore. `notify()` wakes up a waiting `wait()`
+    immediately (used by the push endpoint).
+
+    The first sync of a process is always a full UNREAD listing. The cursor only
+    moves when the caller `commit()`s a batch, i.e. once it was handed off, not when
+    it is answered, so messages that were still queued when the last process
+    stopped are only found that way. A batch that is not committed is returned again.
+    """
+
+    def __init__(self, service, cursor_file=HISTORY_CURSOR_FILE):
+        self.service = service
+        self.cursor_file = cursor_file
+        self.history_id = self._load_cursor()
+        self._listed = False #* Full listing done in this process
+        self._event = threading.Event()
+        self._seen = set()
+        self._seen_order = deque()
+        self._batch = None #* (historyId, messages) of the last fetch_new(), until commit()
+        self._retry = [] #* Messages the caller could not hand off, returned first by the next fetch_new()
+
+    def _load_cursor(self):
+        if not os.path.exists(self.cursor_file):
+            return None
+        try:
+            with open(self.cursor_file, "r", encoding="utf-8") as f:
+                return json.load(f).get("historyId")
+        except Exception as e:
+            print(f"Could not read history cursor: {e}")
+            return None
+
+    def _save_cursor(self):
+        tmp_file = self.cursor_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"historyId": self.history_id}, f)
+        os.replace(tmp_file, self.cursor_file) #* Atomic, a crash never leaves a half written cursor
+
+    def _remember(self, msg_id):
+        if msg_id in self._seen:
+            return False
+        self._seen.add(msg_id)
+        self._seen_order.append(msg_id)
+        if len(self._seen_order) > SEEN_CACHE_SIZE:
+            self._seen.discard(self._seen_order.popleft())
+        return True
+
+    def notify(self, history_id=None):
+        """Wake up the sync loop. Called by the push endpoint (or anything else)."""
+        self._event.set()
+
+    def wait(self, timeout):
+        """Blocks until a notification arrives or the timeout (fallback poll) is reached."""
+        notified = self._event.wait(timeout)
+        self._event.clear()
+        return notified
+
+    def bootstrap(self):
+        """Full listing of all UNREAD inbox messages, used at startup and when the cursor is no longer valid."""
+        with self.service.checkout() as gmail:
+            profile = gmail.users().getProfile(userId='me').execute()
+        history_id = profile["historyId"] #* Taken before listing, so nothing between both calls gets lost
+
+        messages = []
+        page_token = None
+        while True:
+            with self.service.checkout() as gmail, metrics.timer("gmail_seconds", op="list"):
+                results = gmail.users().messages().list(userId='me', labelIds=['INBOX', 'UNREAD'], pageToken=page_token).execute()
+            messages.extend(results.get('messages', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        print(f"Inbox bootstrapped at historyId {history_id} with {len(messages)} unread message(s).")
+        return self._stage(history_id, messages)
+
+    def _stage(self, history_id, messages):
+        batch = {m['id']: m for m in self._retry}
+        for m in messages:
+            if m['id'] not in self._seen:
+                batch.setdefault(m['id'], m)
+        self._batch = (history_id, list(batch.values()))
+        return list(batch.values())
+
+    def commit(self, retry=()):
+        """The last fetch_new() batch was handed off, except `retry`. Saves the cursor and remembers the ids."""
+        if not self._batch:
+            return
+        history_id, messages = self._batch
+        self._batch = None
+        retry_ids = {m['id'] for m in retry}
+        for m in messages:
+            if m['id'] not in retry_ids:
+                self._remember(m['id'])
+        self._retry = list(retry)
+        self._listed = True
+        if history_id != self.history_id:
+            self.history_id = history_id
+            self._save_cursor()
+
+    def fetch_new(self):
+        """Returns all messages added to the inbox since the stored cursor. Call commit() once they are handed off."""
+        if not self.history_id or not self._listed:
+            return self.bootstrap()
+
+        messages = []
+        page_token = None
+        latest_history_id = self.history_id
+        try:
+            while True:
+                with self.service.checkout() as gmail, metrics.timer("gmail_seconds", op="list"):
+                    results = gmail.users().history().list(
+                        userId='me', startHistoryId=self.history_id, historyTypes=['messageAdded'],
+                        labelId='INBOX', pageToken=page_token
+                    ).execute()
+
+                for record in results.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        message = added['message']
+                        labels = message.get('labelIds', [])
+                        if 'INBOX' in labels and 'UNREAD' in labels:
+                            messages.append({"id": message['id'], "threadId": message['threadId']})
+
+                latest_history_id = results.get('historyId', latest_history_id)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+
+        except HttpError as e:
+            if e.resp.status == 404: #! Cursor is too old (Gmail keeps history only for about a week)
+                print(f"History cursor {self.history_id} expired. Falling back to full listing.")
+                return self.bootstrap()
+            raise
+
+        return self._stage(latest_history_id, messages)
+
+
+class _PushHandler(BaseHTTPRequestHandler):
+    sync = None
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length) if length else b''
+        history_id = None
+        try: #* Accepts the Pub/Sub push format, but an empty POST is enough to trigger a sync
+            envelope = json.loads(raw or b'{}')
+            data = envelope.get("message", {}).get("data")
+            if data:
+                history_id = json.loads(base64.b64decode(data)).get("historyId")
+        except Exception:
+            pass
+
+        self.sync.notify(history_id)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass #* Keep the console clean
+
+
+def start_push_listener(sync, port, host="127.0.0.1"):
+    """Starts a local HTTP endpoint that triggers `sync.notify()` on every POST.
+
+    Stand-in for a Gmail Pub/Sub push subscription.
+    """
+    handler = type("PushHandler", (_PushHandler,), {"sync": sync})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="PushListener", daemon=True).start()
+    print(f"Push listener running on http://{host}:{port}/")
+    return server
@@ -0,0 +1,149 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "none") #* "none" (single instance), "sqlite" (processes on one machine) or "mongo" (several machines)
+LEASE_TTL = int(os.getenv("LEASE_TTL", "60")) #* Seconds until the lease of a crashed instance can be taken over
+LEASE_DB_FILE = os.getenv("LEASE_DB_FILE", "leases.sqlite3")
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class Leases:
+    """Short-lived, renewable locks shared between instances (e.g. "thread:<threadId>").
+
+    A lease belongs to one owner until it is released or expires. `start_heartbeat()`
+    renews all held leases every TTL/3, so only crashed (or hanging) instances lose them.
+    Subclasses implement `_acquire`, `_release` and `_renew` for their storage.
+    """
+
+    def __init__(self, owner=None, ttl=LEASE_TTL):
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """True if this instance owns the lease now (new, expired or already ours)."""
+        if not self._acquire(key):
+            return False
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def release(self, key):
+        with self._lock:
+            self._held.discard(key)
+        self._release(key)
+
+    def renew(self):
+        with self._lock:
+            keys = list(self._held)
+        if not keys:
+            return
+        renewed = self._renew(keys)
+        if renewed < len(keys): #! Another instance took over after our lease expired, e.g. after a long pause
+            print(f"Lost {len(keys) - renewed} of {len(keys)} lease(s).")
+
+    def start_heartbeat(self):
+        def beat():
+            while True:
+                time.sleep(self.ttl / 3)
+                try:
+                    self.renew()
+                except Exception as e:
+                    print(f"Error while renewing leases: {e}")
+        threading.Thread(target=beat, name="LeaseHeartbeat", daemon=True).start()
+        print(f"Leases enabled for owner '{self.owner}' ({type(self).__name__}, ttl {self.ttl}s).")
+
+class MongoLeases(Leases):
+    """Leases in a MongoDB collection, for instances on several machines."""
+
+    def __init__(self, collection, owner=None, ttl=LEASE_TTL):
+        super().__init__(owner, ttl)
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([("expiresAt", pymongo.ASCENDING)], expireAfterSeconds=0, name="expiresAt_ttl") #* Mongo cleans up leases of crashed instances
+
+    def _expires(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+
+    def _acquire(self, key):
+        now = datetime.now(timezone.utc)
+        try: #* Only matches a lease that is ours or expired, otherwise the upsert collides with the existing _id
+            self.collection.update_one(
+                {"_id": key, "$or": [{"owner": self.owner}, {"expiresAt": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expiresAt": self._expires()}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def _release(self, key):
+        self.collection.delete_one({"_id": key, "owner": self.owner})
+
+    def _renew(self, keys):
+        result = self.collection.update_many({"_id": {"$in": keys}, "owner": self.owner}, {"$set": {"expiresAt": self._expires()}})
+        return result.matched_count
+
+class SqliteLeases(Leases):
+    """Leases in a local SQLite file, for several processes on one machine."""
+
+    def __init__(self, path=LEASE_DB_FILE, owner=None, ttl=LEASE_TTL):
+        super().__init__(owner, ttl)
+        self.path = path
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self): #* One connection per call, sqlite3 connections can not be shared between threads
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db: #* Commits (or rolls back) the statement
+                yield db
+        finally:
+            db.close()
+
+    def _acquire(self, key):
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (key, self.owner, now + self.ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def _release(self, key):
+        with self._connect() as db:
+            db.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def _renew(self, keys):
+        with self._connect() as db:
+            cursor = db.execute(
+                f"UPDATE leases SET expires = ? WHERE owner = ? AND key IN ({', '.join('?' * len(keys))})",
+                [time.time() + self.ttl, self.owner, *keys]
+            )
+            return cursor.rowcount
+
+def create_leases(backend=LEASE_BACKEND, database=None):
+    """Returns the configured lease store (with running heartbeat), or None for a single instance."""
+    if backend == "mongo":
+        leases = MongoLeases(database["leases"])
+        leases.ensure_indexes()
+    elif backend == "sqlite":
+        leases = SqliteLeases()
+    else:
+        return None
+    leases.start_heartbeat()
+    return leases
@@ -1,3 +1,3 @@
 import threading
 
-gmail_lock = threading.Lock()
+token_lock = threading.Lock() #* Guards the refresh of the shared Gmail credentials
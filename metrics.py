@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) #* 0 = no /metrics endpoint
+JSON_LOG = os.getenv("METRICS_JSON_LOG", "0") == "1" #* One JSON line per finished message
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) #* Seconds
+
+_message = contextvars.ContextVar("message_metrics", default=None)
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Process wide counters, histograms and gauges in the Prometheus text format.
+
+    Timings are also added to the record of the message that is currently
+    processed (see `track_message()`), which is logged as one JSON line.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {} #* name -> function, read on every scrape
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, record=None, **labels):
+        key = _key(name, labels)
+        record = record if record is not None else _message.get()
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+            if record is not None:
+                stage = ":".join([name] + [str(v) for _, v in key[1]]) #* e.g. gmail_seconds:get
+                record["stages"][stage] = round(record["stages"].get(stage, 0) + seconds, 6)
+
+    @contextmanager
+    def timer(self, name, record=None, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, record, **labels)
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.sum, h.count) for key, h in histograms]
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), counts, total, count in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def annotate(**fields):
+    """Adds fields to the record of the current message (if there is one)."""
+    record = _message.get()
+    if record is not None:
+        record.update(fields)
+
+def new_record(msg_id):
+    return {"msg_id": msg_id, "stages": {}, "start": time.perf_counter()}
+
+def log_record(record):
+    """Observes the total time of a message and writes its JSON line (if enabled)."""
+    total = time.perf_counter() - record.pop("start")
+    metrics.observe("message_seconds", total)
+    if JSON_LOG:
+        print(json.dumps({"ts": time.time(), **record, "total": round(total, 6)}, default=str))
+
+@contextmanager
+def use_record(record):
+    """Timings in this context (threads started with a copy of it included) are added to `record`."""
+    token = _message.set(record)
+    try:
+        yield record
+    finally:
+        _message.reset(token)
+
+@contextmanager
+def track_message(msg_id):
+    """Collects all timings of one message into a record and logs it at the end.
+
+    Other fields (model, plan, tokens, label, ...) can be set on the yielded dict.
+    """
+    record = new_record(msg_id)
+    try:
+        with use_record(record):
+            yield record
+    finally:
+        log_record(record)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): #* No access log for every scrape
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
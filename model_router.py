@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+
+from clients import genai_errors as errors
+from registry import registry
+from scheduler import RetryLater
+from metrics import metrics
+
+WINDOW = int(os.getenv("ROUTER_WINDOW", "50")) #* Last calls per model used for latency and error rate
+MIN_CALLS = 5 #* Calls needed before the error rate can open a circuit
+ERROR_THRESHOLD = float(os.getenv("ROUTER_ERROR_THRESHOLD", "0.5")) #* Error rate that opens the circuit
+CONSECUTIVE_FAILURES = 3 #* Opens the circuit without waiting for MIN_CALLS
+SLOW_CALL = float(os.getenv("ROUTER_SLOW_CALL", "60")) #* Seconds, slower answers are used but count as errors
+OPEN_SECONDS = float(os.getenv("ROUTER_OPEN_SECONDS", "30")) #* Time until a half-open probe is allowed
+MAX_ATTEMPTS = 2 #* Models tried per message
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class ModelUnavailable(RetryLater):
+    pass
+
+def is_model_error(e):
+    """Errors caused by the model/API side (overloaded, rate limited, 5xx), not by the request."""
+    if isinstance(e, (errors.ServerError, TimeoutError)): #* Also a stream that sent nothing before its deadline
+        return True
+    if isinstance(e, errors.APIError) and e.code == 429:
+        return True
+    return "The model is overloaded" in str(e)
+
+def _percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+class ModelHealth:
+    """Rolling latency/error window and circuit state of one model."""
+
+    def __init__(self):
+        self.calls = deque(maxlen=WINDOW) #* (latency, ok)
+        self.failures = 0 #* Consecutive
+        self.state = CLOSED
+        self.opened_at = 0
+        self.probing = False
+
+    def error_rate(self):
+        if not self.calls:
+            return 0
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls)
+
+    def p(self, percentile):
+        return _percentile([latency for latency, ok in self.calls if ok], percentile)
+
+class ModelRouter:
+    """Picks the model for a request based on the health of each model.
+
+    A model whose recent calls fail (or are slower than SLOW_CALL) gets an open
+    circuit and is skipped for OPEN_SECONDS. Its requests go straight to a healthy
+    model with the same or a lower perm_level_required. After that one real
+    request is let through as a probe (half-open). It closes the circuit again
+    on success and reopens it on failure.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback #* Preferred when several models qualify
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model):
+        if model not in self._health:
+            self._health[model] = ModelHealth()
+        return self._health[model]
+
+    def _allow(self, model, now):
+        health = self._get(model)
+        if health.state == CLOSED:
+            return True
+        if health.state == OPEN and now - health.opened_at >= OPEN_SECONDS:
+            health.state = HALF_OPEN
+        if health.state == HALF_OPEN and not health.probing:
+            health.probing = True
+            return True
+        return False
+
+    def _candidates(self, preferred, exclude):
+        models = registry.models
+        level = models.get(preferred, {}).get("perm_level_required", 0)
+        candidates = [name for name, model in models.items()
+                      if name != preferred and name not in exclude and model["active"] and model["perm_level_required"] <= level]
+        #* Closest permission level first, then the configured fallback, then the fastest model
+        return sorted(candidates, key=lambda name: (-models[name]["perm_level_required"], name != self.fallback, self._get(name).p(0.95) or 0))
+
+    def route(self, preferred, exclude=()):
+        """Returns the model to use. Raises ModelUnavailable if every suitable circuit is open."""
+        with self._lock:
+            now = time.monotonic()
+            if preferred not in exclude and self._allow(preferred, now):
+                return preferred
+            for name in self._candidates(preferred, exclude):
+                if self._allow(name, now):
+                    return name
+            retry_in = min((OPEN_SECONDS - (now - h.opened_at) for h in self._health.values() if h.state == OPEN), default=OPEN_SECONDS)
+            raise ModelUnavailable(max(retry_in, 1), f"No healthy model available for '{preferred}'.")
+
+    def record(self, model, latency, ok):
+        metrics.observe("ai_call_seconds", latency, model=model, outcome="ok" if ok else "error")
+        with self._lock:
+            health = self._get(model)
+            ok = ok and latency <= SLOW_CALL
+            health.calls.append((latency, ok))
+            health.failures = 0 if ok else health.failures + 1
+            if health.state == HALF_OPEN:
+                health.probing = False
+                if ok:
+                    health.state = CLOSED
+                    health.calls.clear() #* Start with a clean window after recovery
+                    health.calls.append((latency, ok))
+                    print(f"Model '{model}' recovered. Circuit closed.")
+                else:
+                    health.state = OPEN
+                    health.opened_at = time.monotonic()
+            elif health.state == CLOSED and not ok:
+                if health.failures >= CONSECUTIVE_FAILURES or (len(health.calls) >= MIN_CALLS and health.error_rate() >= ERROR_THRESHOLD):
+                    health.state = OPEN
+                    health.opened_at = time.monotonic()
+                    print(f"Model '{model}' is failing ({health.error_rate():.0%} errors). Circuit opened for {OPEN_SECONDS:.0f}s.")
+
+    def release(self, model):
+        """Frees the probe slot of a half-open model if the probe never reached the model."""
+        with self._lock:
+            self._get(model).probing = False
+
+    def ask(self, preferred, call, prepare=None):
+        """Runs `call(model, prepared)` on the routed model and tries the next one on a model error. Returns (model, result).
+
+        `prepare(model)` runs first and is not part of the measured latency (e.g. waiting for the rate limiter).
+        """
+        tried = []
+        while True:
+            model = self.route(preferred, tried)
+            try:
+                prepared = prepare(model) if prepare else None
+            except Exception:
+                self.release(model)
+                raise
+            start = time.perf_counter()
+            try:
+                result = call(model, prepared)
+            except Exception as e:
+                if not is_model_error(e):
+                    self.release(model)
+                    raise
+                self.record(model, time.perf_counter() - start, False)
+                tried.append(model)
+                if len(tried) >= MAX_ATTEMPTS or isinstance(e, TimeoutError): #* The deadline covers the whole message, a retry would start a new one
+                    raise
+                print(f"Model '{model}' failed ({e}). Asking again using another model.")
+                continue
+            self.record(model, time.perf_counter() - start, True)
+            return model, result
+
+    async def ask_async(self, preferred, call, prepare=None):
+        """Same as ask() with coroutine functions. Waits instead of raising ModelUnavailable."""
+        tried = []
+        while True:
+            try:
+                model = self.route(preferred, tried)
+            except ModelUnavailable as e:
+                if tried:
+                    raise
+                await asyncio.sleep(e.delay)
+                continue
+            try:
+                prepared = await prepare(model) if prepare else None
+            except BaseException: #* Also on cancellation, otherwise the probe slot stays taken
+                self.release(model)
+                raise
+            start = time.perf_counter()
+            try:
+                result = await call(model, prepared)
+            except Exception as e:
+                if not is_model_error(e):
+                    self.release(model)
+                    raise
+                self.record(model, time.perf_counter() - start, False)
+                tried.append(model)
+                if len(tried) >= MAX_ATTEMPTS or isinstance(e, TimeoutError): #* The deadline covers the whole message, a retry would start a new one
+                    raise
+                print(f"Model '{model}' failed ({e}). Asking again using another model.")
+                continue
+            self.record(model, time.perf_counter() - start, True)
+            return model, result
+
+    def stats(self):
+        """p50/p95 latency, error rate and circuit state per model."""
+        with self._lock:
+            return {model: {"p50": h.p(0.5), "p95": h.p(0.95), "error_rate": h.error_rate(), "state": h.state}
+                    for model, h in self._health.items()}
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+from config import LABELS
+from gmail_labels import mark_labels, OPEN_LABELS
+from metrics import metrics
+
+OUTBOX_DB_FILE = os.getenv("OUTBOX_DB_FILE", "outbox.sqlite3")
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "2"))
+MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "8")) #* With the backoff below about 20 minutes of retries
+BACKOFF_BASE = 5 #* Seconds before the first retry, doubled for every further one
+BACKOFF_MAX = 900
+CLAIM_TIMEOUT = 120 #* A claimed reply is taken over after this, e.g. when its worker died
+KEEP_DAYS = 7 #* Finished entries are kept this long, so a redelivered message is not answered twice
+PERMANENT_ERRORS = (400, 404) #* Gmail rejected the message itself, retrying does not help
+LEASE_RETRY = 30 #* Seconds until a left over reply whose thread is leased by another instance is tried again
+
+FINAL_LABELS = {"done": "answered", "failed": "broken"} #* Label of the answered messages for a finished reply
+
+#* pending -> sending -> sent (Gmail accepted it) -> done (labelled "answered"), or failed after MAX_ATTEMPTS
+SCHEMA = """CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    reply_id TEXT NOT NULL,
+    msg_ids TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    gmail_id TEXT,
+    error TEXT
+)"""
+
+def reply_key(thread_id, message_id): #* Idempotency key, one reply per answered message of a thread
+    return f"{thread_id}|{message_id}"
+
+def reply_message_id(thread_id, message_id):
+    """Message-ID header of our reply. Fixed per key, so a send with unknown outcome can be looked up in Gmail."""
+    digest = hashlib.sha256(reply_key(thread_id, message_id).encode()).hexdigest()[:32]
+    return f"<{digest}@email-ai.reply>"
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(0.8, 1.2)
+
+class Outbox:
+    """Durable queue of rendered replies in a local SQLite file, sent by background workers.
+
+    AI workers only `enqueue()` the finished reply. The send workers retry with
+    exponential backoff and label the messages "answered" only after Gmail accepted
+    the reply, so a send error no longer loses a paid answer. Replies of one thread
+    are sent in order. With `threads` (the ThreadQueue) every unfinished reply keeps
+    the lease of its thread, so no other instance answers the message again meanwhile.
+    """
+
+    def __init__(self, path=OUTBOX_DB_FILE):
+        self.path = path
+        self.service = None
+        self.threads = None
+        self._tracked = set() #* Keys registered with threads.deliver()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._wake = threading.Event()
+        self._threads = []
+
+    @contextmanager
+    def _connect(self): #* One connection per call, sqlite3 connections can not be shared between threads
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            if not self._ready:
+                db.execute(SCHEMA)
+                db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)")
+                self._ready = True
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, thread_id, message_id, msg_ids, body):
+        """Adds a reply. Returns False if this message already has one (it is not sent twice)."""
+        now = time.time()
+        key = reply_key(thread_id, message_id)
+        self._track(key, thread_id) #* Before the insert, a send worker may finish the reply right after it
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO outbox (key, thread_id, reply_id, msg_ids, body, status, next_attempt, created) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+                (key, thread_id, reply_message_id(thread_id, message_id), json.dumps(msg_ids), json.dumps(body), now, now)
+            )
+            if cursor.rowcount != 1 and db.execute("SELECT status FROM outbox WHERE key = ?", (key,)).fetchone()[0] in FINAL_LABELS:
+                self._untrack(key, thread_id)
+        self._wake.set()
+        return cursor.rowcount == 1
+
+    def _track(self, key, thread_id):
+        """Keeps the thread's lease until _untrack(). False if another instance holds it."""
+        with self._lock:
+            if not self.threads or key in self._tracked:
+                return True
+            if not self.threads.deliver(thread_id):
+                return False
+            self._tracked.add(key)
+            return True
+
+    def _untrack(self, key, thread_id):
+        with self._lock:
+            if key in self._tracked:
+                self._tracked.discard(key)
+                self.threads.delivered(thread_id)
+
+    def _msg_ids(self, key): #* Read again before labelling, adopt() may have added some
+        with self._connect() as db:
+            return json.loads(db.execute("SELECT msg_ids FROM outbox WHERE key = ?", (key,)).fetchone()[0])
+
+    def adopt(self, thread_id, message_id, msg_ids):
+        """Status of the reply to a message, None if there is none. An unfinished reply also labels `msg_ids` when it is done."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT status, msg_ids FROM outbox WHERE key = ?", (reply_key(thread_id, message_id),)).fetchone()
+                if row and row[0] in ("pending", "sending", "sent"): #* e.g. a held message reclaimed together with the answered one
+                    merged = list(dict.fromkeys(json.loads(row[1]) + list(msg_ids)))
+                    db.execute("UPDATE outbox SET msg_ids = ? WHERE key = ?", (json.dumps(merged), reply_key(thread_id, message_id)))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return row[0] if row else None
+
+    def pending(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending', 'sent')").fetchone()[0]
+
+    def _claim(self):
+        """Takes the oldest due reply whose thread has no older unfinished one. Returns a row dict or None."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE") #* Only one worker claims at a time
+            try:
+                row = db.execute(
+                    "SELECT key, thread_id, reply_id, msg_ids, body, status, attempts FROM outbox o "
+                    "WHERE status IN ('pending', 'sending', 'sent') AND next_attempt <= ? AND NOT EXISTS ("
+                    "SELECT 1 FROM outbox older WHERE older.thread_id = o.thread_id AND older.created < o.created "
+                    "AND older.status IN ('pending', 'sending', 'sent')) ORDER BY created LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row:
+                    #* "sending" stays set until Gmail confirmed, a reply claimed in that state may have been sent already
+                    db.execute("UPDATE outbox SET status = CASE status WHEN 'sent' THEN 'sent' ELSE 'sending' END, next_attempt = ? WHERE key = ?", (now + CLAIM_TIMEOUT, row[0]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return dict(zip(("key", "thread_id", "reply_id", "msg_ids", "body", "status", "attempts"), row))
+
+    def _update(self, key, **fields):
+        with self._connect() as db:
+            db.execute(f"UPDATE outbox SET {', '.join(f'{name} = ?' for name in fields)} WHERE key = ?", (*fields.values(), key))
+
+    def _next_due(self):
+        with self._connect() as db:
+            row = db.execute("SELECT MIN(next_attempt) FROM outbox WHERE status IN ('pending', 'sending', 'sent')").fetchone()
+        return row[0]
+
+    def _find_sent(self, reply_id): #* Did an earlier attempt reach Gmail before the worker lost track of it?
+        with self.service.checkout() as gmail, metrics.timer("gmail_seconds", op="list"):
+            results = gmail.users().messages().list(userId='me', q=f"rfc822msgid:{reply_id}").execute()
+        messages = results.get('messages', [])
+        return messages[0]['id'] if messages else None
+
+    def _finished_elsewhere(self, msg_ids): #* Answered by another instance while this one was down
+        futures = [self.service.get_message(msg_id, format='minimal') for msg_id in msg_ids]
+        return not any(OPEN_LABELS.intersection(future.result().get('labelIds', [])) for future in futures)
+
+    def _send(self, row):
+        if self.threads and row["key"] not in self._tracked: #* Left over from the last run, the lease was lost with it
+            if not self._track(row["key"], row["thread_id"]):
+                print(f"Thread of reply '{row['key']}' is leased by another instance. Retry in {LEASE_RETRY}s.")
+                self._update(row["key"], status=row["status"], next_attempt=time.time() + LEASE_RETRY)
+                return
+            if row["status"] != "sent" and self.threads.leases and self._finished_elsewhere(json.loads(row["msg_ids"])):
+                print(f"Messages of reply '{row['key']}' were finished by another instance, not sending it.")
+                self._update(row["key"], status="done", body="")
+                self._untrack(row["key"], row["thread_id"])
+                return
+        if row["status"] != "sent":
+            gmail_id = self._find_sent(row["reply_id"]) if row["status"] == "sending" or row["attempts"] else None #* Outcome of an earlier attempt unknown
+            if not gmail_id:
+                with self.service.checkout() as gmail, metrics.timer("gmail_seconds", op="send"):
+                    gmail_id = gmail.users().messages().send(userId='me', body=json.loads(row["body"])).execute().get('id')
+                print(f"Replying to '{row['key']}'")
+            self._update(row["key"], status="sent", gmail_id=gmail_id, body="") #* The raw message is not needed anymore
+            metrics.inc("outbox_total", outcome="sent")
+        while True:
+            msg_ids = self._msg_ids(row["key"])
+            mark_labels(self.service, msg_ids, LABELS["answered"])
+            with self._connect() as db: #* Only if adopt() added nothing while labelling, otherwise label the new ones too
+                if db.execute("UPDATE outbox SET status = 'done' WHERE key = ? AND msg_ids = ?", (row["key"], json.dumps(msg_ids))).rowcount:
+                    break
+        self._untrack(row["key"], row["thread_id"])
+
+    def _failed(self, row, error):
+        attempts = row["attempts"] + 1
+        permanent = isinstance(error, HttpError) and error.resp.status in PERMANENT_ERRORS
+        if row["status"] != "sent" and (permanent or attempts >= MAX_ATTEMPTS):
+            print(f"Giving up on reply '{row['key']}' after {attempts} attempt(s): {error}")
+            self._update(row["key"], status="failed", attempts=attempts, error=str(error))
+            metrics.inc("outbox_total", outcome="failed")
+            try:
+                mark_labels(self.service, self._msg_ids(row["key"]), LABELS["broken"])
+            finally: #* Not retried anymore, the lease has to go
+                self._untrack(row["key"], row["thread_id"])
+            return
+        delay = backoff(attempts)
+        print(f"Sending reply '{row['key']}' failed ({error}). Retry {attempts} in {delay:.0f}s.")
+        self._update(row["key"], attempts=attempts, next_attempt=time.time() + delay, error=str(error))
+        metrics.inc("outbox_total", outcome="retry")
+
+    def _worker(self):
+        while True:
+            self._wake.clear() #* Before the claim, so an enqueue in between is not missed
+            try:
+                row = self._claim()
+            except Exception as e:
+                print(f"Error while reading the outbox: {e}")
+                row = None
+            if row is None:
+                next_due = self._next_due()
+                self._wake.wait(timeout=min(max(next_due - time.time(), 0.5), 5) if next_due else 5) #* Due replies may wait for an older one of their thread
+                continue
+            try:
+                self._send(row)
+            except Exception as e:
+                try:
+                    self._failed(row, e)
+                except Exception as inner:
+                    print(f"Error while rescheduling reply '{row['key']}': {inner}") #* Claim times out, it is retried then
+
+    def purge(self, days=KEEP_DAYS):
+        with self._connect() as db:
+            db.execute("DELETE FROM outbox WHERE status IN ('done', 'failed') AND created < ?", (time.time() - days * 86400,))
+
+    def start(self, service, threads=None, workers=SEND_WORKERS):
+        """Starts the send workers. Replies left over from the last run are sent first."""
+        if self._threads: #* The threaded engine starts it again when the async engine stopped
+            return
+        self.service = service
+        self.threads = threads
+        self.purge()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"Sender-{i + 1}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        metrics.gauge("outbox_pending", self.pending)
+        print(f"Outbox started with {workers} send worker(s), {self.pending()} reply(s) pending.")
+
+outbox = Outbox()
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+
+from registry import registry
+from scheduler import RetryLater
+
+#* Tokens per hour for each plan, None = unlimited
+PLAN_TOKENS_PER_HOUR = {
+    "Developer": None,
+    "Premium": int(os.getenv("PREMIUM_TOKENS_PER_HOUR", "2000000")),
+    "Free": int(os.getenv("FREE_TOKENS_PER_HOUR", "500000")),
+    "Unregistered": int(os.getenv("UNREGISTERED_TOKENS_PER_HOUR", "100000"))
+}
+EXPECTED_OUTPUT_TOKENS = 1000 #* Added to every estimate, corrected with the real usage afterwards
+IMAGE_TOKENS = 258 #* Gemini counts images (and PDF pages) with a fixed size
+MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "5")) #* Longer waits give the job back to the queue instead of blocking a worker
+
+class RateLimited(RetryLater):
+    pass
+
+class TokenBucket:
+    def __init__(self, per_hour):
+        self.capacity = per_hour
+        self.rate = per_hour / 3600
+        self.tokens = per_hour
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity) #* A request larger than the bucket waits for a full bucket
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    """Token buckets per model (context_per_hour from models.json) and per plan, shared by all workers.
+
+    `acquire()` takes the estimated cost from both buckets at once, `settle()`
+    corrects it with the real token count. A quota of 0 in models.json means no limit.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._model_buckets = {}
+        self._plan_buckets = {plan: TokenBucket(limit) for plan, limit in PLAN_TOKENS_PER_HOUR.items() if limit}
+        self._models_version = None
+
+    def _sync_models(self):
+        snapshot = registry.snapshot
+        if snapshot.version == self._models_version:
+            return
+        for name, model in snapshot.models.items(): #* Keep the state of buckets whose quota did not change
+            limit = model.get("context_per_hour", 0)
+            if not limit:
+                self._model_buckets.pop(name, None)
+            elif name not in self._model_buckets or self._model_buckets[name].capacity != limit:
+                self._model_buckets[name] = TokenBucket(limit)
+        self._models_version = snapshot.version
+
+    def _buckets(self, model, plan):
+        return [b for b in (self._model_buckets.get(model), self._plan_buckets.get(plan)) if b]
+
+    def try_acquire(self, model, plan, cost):
+        """Takes `cost` tokens if possible. Returns (reservation, 0) or (None, seconds to wait)."""
+        with self._lock:
+            self._sync_models()
+            now = time.monotonic()
+            buckets = self._buckets(model, plan)
+            wait = max((b.wait_time(cost, now) for b in buckets), default=0)
+            if wait > 0:
+                return None, wait
+            for bucket in buckets:
+                bucket.take(cost)
+            return (model, plan, cost), 0
+
+    def acquire(self, model, plan, cost, max_wait=MAX_WAIT):
+        """Blocks until the budget is available. Raises RateLimited if that would take longer than `max_wait`."""
+        deadline = time.monotonic() + max_wait
+        while True:
+            reservation, wait = self.try_acquire(model, plan, cost)
+            if reservation:
+                return reservation
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(wait, f"Rate limit reached for '{model}' / {plan}. Retry in {wait:.1f}s.")
+            with self._lock:
+                self._lock.wait(wait)
+
+    def settle(self, reservation, actual):
+        """Corrects the estimated cost with the real token count (gives back or takes the difference)."""
+        model, plan, estimated = reservation
+        with self._lock:
+            for bucket in self._buckets(model, plan):
+                bucket.tokens = min(bucket.capacity, bucket.tokens - (actual - estimated))
+            self._lock.notify_all()
+
+    def remaining(self, model, plan):
+        """Tokens left right now for a model and a plan, None = unlimited."""
+        with self._lock:
+            self._sync_models()
+            now = time.monotonic()
+            result = {}
+            for key, bucket in (("model", self._model_buckets.get(model)), ("plan", self._plan_buckets.get(plan))):
+                if bucket:
+                    bucket._refill(now)
+                result[key] = int(bucket.tokens) if bucket else None
+            return result
+
+def estimate_cost(question, attachments):
+    """Rough token estimate of a request before it is sent (~4 characters per token)."""
+    cost = len(question) // 4 + EXPECTED_OUTPUT_TOKENS
+    for attachment in attachments or []:
+        if attachment.mimeType.startswith("image/") or attachment.mimeType == "application/pdf":
+            cost += IMAGE_TOKENS * max(1, attachment.size // 100000) #* ~1 page per 100 KB
+        else:
+            cost += attachment.size // 4
+    return cost
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import signal
+import threading
+
+from clients import Lazy
+
+USERS_FILE = "users.json"
+MODELS_FILE = "models.json"
+RELOAD_INTERVAL = 5 #* Seconds between mtime checks
+
+class Snapshot:
+    """Immutable view of users and models. Replaced as a whole on reload, never changed in place."""
+
+    def __init__(self, users, models, version):
+        self.users = users
+        self.models = models
+        self.version = version
+        self.users_by_email = {u["email"].lower(): u for u in users}
+
+class Registry:
+    """Loads users.json and models.json once and keeps them in memory.
+
+    Readers just take `self.snapshot` (one attribute read, no lock). A background
+    thread reloads the files when their mtime changes, SIGHUP forces a reload.
+    """
+
+    def __init__(self, users_file=USERS_FILE, models_file=MODELS_FILE):
+        self.users_file = users_file
+        self.models_file = models_file
+        self._mtimes = None
+        self._version = 0
+        self._reload_lock = threading.Lock()
+        self.snapshot = None
+        self.reload()
+
+    def _read_mtimes(self):
+        return (os.path.getmtime(self.users_file), os.path.getmtime(self.models_file))
+
+    def reload(self):
+        with self._reload_lock:
+            mtimes = self._read_mtimes()
+            with open(self.users_file, "r", encoding="utf-8") as f:
+                users = json.load(f)
+            with open(self.models_file, "r", encoding="utf-8") as f:
+                models = json.load(f)
+
+            self._version += 1
+            self.snapshot = Snapshot(users, models, self._version) #* Atomic swap, readers see either the old or the new data
+            self._mtimes = mtimes
+        print(f"Registry loaded: {len(users)} user(s), {len(models)} model(s). (v{self._version})")
+
+    def reload_if_changed(self):
+        try:
+            if self._read_mtimes() != self._mtimes:
+                self.reload()
+        except Exception as e: #! Keep serving the old data when a file is broken or half written
+            print(f"Registry reload failed: {e}")
+
+    def start_watcher(self, interval=RELOAD_INTERVAL):
+        def watch():
+            while True:
+                time.sleep(interval)
+                self.reload_if_changed()
+        threading.Thread(target=watch, name="RegistryWatcher", daemon=True).start()
+
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self._forced_reload, daemon=True).start())
+
+    def _forced_reload(self):
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"Registry reload failed: {e}")
+
+    def get_user(self, email):
+        return self.snapshot.users_by_email.get(email.lower()) if email else None
+
+    @property
+    def models(self):
+        return self.snapshot.models
+
+registry = Lazy(Registry) #* The files are read on first use, not on import
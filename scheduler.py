@@ -0,0 +1,79 @@
+import threading
+import itertools
+import queue
+
+#* Lower number = processed first
+PLAN_PRIORITY = {
+    "Developer": 0,
+    "Premium": 1,
+    "Free": 2,
+    "Unregistered": 3
+}
+
+class RetryLater(Exception):
+    """Raised by a handler to put its job back into the queue after `delay` seconds.
+
+    A handler can set `job` to the arguments to retry with, if they are not the ones it was called with.
+    """
+
+    def __init__(self, delay, message=""):
+        super().__init__(message)
+        self.delay = delay
+        self.job = None
+
+class Scheduler:
+    """Fixed size worker pool that takes jobs from a priority queue keyed on the user's plan.
+
+    Jobs with the same priority are processed in submission order.
+    """
+
+    def __init__(self, handler, workers=4):
+        self.handler = handler
+        self.workers = workers
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count() #* Tie breaker, keeps FIFO order inside one priority
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"Worker-{i + 1}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"Scheduler started with {self.workers} worker(s).")
+
+    def submit(self, plan, *args):
+        priority = PLAN_PRIORITY.get(plan, PLAN_PRIORITY["Unregistered"])
+        self._queue.put((priority, next(self._counter), args))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                self.handler(*item[2])
+            except RetryLater as e: #* Same priority and position, so it does not fall behind newer jobs
+                retry = item if e.job is None else (item[0], item[1], e.job)
+                timer = threading.Timer(e.delay, self._queue.put, (retry,))
+                timer.daemon = True
+                timer.start()
+            except Exception as e:
+                print(f"A error appeared inside worker {threading.current_thread().name}. {e}")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._queue.task_done()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    def stats(self):
+        return {"queued": self.queue_depth, "in_flight": self.in_flight, "workers": self.workers}
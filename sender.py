@@ -1,146 +1,268 @@
-import time
-import requests
+import asyncio
 import base64
-import threading #* Needed for gmail_lock
 
-from datetime import datetime, timedelta
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
-from google.genai import types
 
-from email_builder import create_email_body
-from locker import gmail_lock
-from main import mark_label, LABELS, DEFAULT_BACKUP_MODEL, aesgcm
-from crypto_utils import seal, open_sealed
+from config import LABELS, DEFAULT_MODEL
+from email_builder import create_email_body, create_plain_body
+from assets import banner_parts
+from clients import keyring
+from gmail_labels import mark_labels
+from crypto_utils import seal, open_sealed, seal_turn, open_turn, turn_is_current, is_current, LAZY_MIGRATION
+from attachments import build_parts, reserve_inline_async, close_all
+from outbox import reply_message_id
+from attachment_store import attachment_store, unique
+from history_cache import history_cache, to_contents, Conversation
+import context_manager
+from model_router import is_model_error
+from streaming import plan_limits, stream_config, collect, collect_async
+from metrics import metrics
 
-ALLOWED_FILE_TYPES = ["image/png", "image/jpeg", "image/webp", "image/heic", "image/heif", 
-                      "application/pdf", "application/x-javascript", "text/javascript", "application/x-python", "text/x-python", "text/plain", "text/html", "text/css", "text/md", "text/csv", "text/xml", "text/rtf",
-                      "audio/wav", "audio/mp3", "audio/aiff", "audio/aac", "audio/ogg", "audio/flac"]
+def load_history(db, thread_id): #* Decrypted conversation of a thread, from the cache or rebuilt from Mongo
+    conversation = history_cache.get(thread_id)
+    if conversation is not None:
+        return conversation
 
-def ask_AI(client, model, question, attachments, db, thread_id, user_id):
+    result = db.load_window(thread_id, context_manager.LOAD_TURNS)
+    if not result:
+        return None
+    missing = _unsummarized_turns(result)
+    if missing:
+        result = db.load_window(thread_id, missing)
+    conversation, turns, summary = _open_history(result)
+    if turns or summary:
+        try:
+            db.migrate(thread_id, turns, summary)
+        except Exception as e: #* Tried again on the next load
+            print(f"Error while migrating thread {thread_id}: {e}")
+    history_cache.put(thread_id, conversation)
+    return conversation
+
+async def load_history_async(db, thread_id): #* Same as load_history(), for the AsyncConversationStore
+    conversation = history_cache.get(thread_id)
+    if conversation is not None:
+        return conversation
+
+    result = await db.load_window(thread_id, context_manager.LOAD_TURNS)
+    if not result:
+        return None
+    missing = _unsummarized_turns(result)
+    if missing:
+        result = await db.load_window(thread_id, missing)
+    conversation, turns, summary = _open_history(result)
+    if turns or summary:
+        try:
+            await db.migrate(thread_id, turns, summary)
+        except Exception as e:
+            print(f"Error while migrating thread {thread_id}: {e}")
+    history_cache.put(thread_id, conversation)
+    return conversation
+
+def _unsummarized_turns(result):
+    """Window size that reaches back to the summary, or 0 if the loaded window already does.
+
+    After failed folds there can be turns between the summary and the last LOAD_TURNS. They are loaded too, so they get summarized.
+    """
+    summarized = result.get("summarized_turns") or 0
+    if result["turn_count"] - len(result["history"]) > summarized:
+        return result["turn_count"] - summarized
+    return 0
+
+def _open_history(result):
+    """Decrypts a loaded window. Also returns the entries to reseal: old format or old key (lazy migration)."""
+    summarized = result.get("summarized_turns") or 0
+    first_index = result["turn_count"] - len(result["history"]) #* Absolute index of the first loaded turn
+
+    chat_history = []
+    turns = {} #* index -> (stored entry, resealed entry)
+    for index, message in enumerate(result["history"], start=first_index):
+        if index < summarized: #* Already part of the summary
+            continue
+        user_text, model_text = open_turn(keyring, message)
+        chat_history.extend(to_contents(user_text, model_text))
+        if LAZY_MIGRATION and not turn_is_current(keyring, message):
+            turns[index] = (message, seal_turn(keyring, user_text, model_text))
+
+    summary = None
+    resealed_summary = None
+    if result.get("summary"):
+        summary = open_sealed(keyring, result["summary"])
+        if LAZY_MIGRATION and not is_current(keyring, result["summary"]):
+            resealed_summary = (result["summary"], seal(keyring, summary))
+    first = max(first_index, summarized) #* Absolute index of the first turn in chat_history
+    return Conversation(chat_history, summary, summarized, result.get("attachments"), first), turns, resealed_summary
+
+def _store(attachments): #* References of the new attachments, stored once per content
+    return attachment_store.put_all(attachments) if attachment_store and attachments else []
+
+def _stored_attachments(conversation, attachments):
+    """Attachments of earlier turns, decrypted from the store. Close them after the request."""
+    if not attachment_store or not conversation.attachments:
+        return []
+    new = {attachment.sha256 for attachment in attachments} #* Sent again with this message anyway
+    return attachment_store.load_all([ref for ref in unique(conversation.attachments) if ref["sha256"] not in new])
+
+def _generate(client, model, contents, limits): #* Streamed within the plan's limits, or one blocking request when streaming is off
+    if not limits:
+        return client.models.generate_content(model=model, contents=contents)
+    return collect(client.models.generate_content_stream(model=model, contents=contents, config=stream_config(limits, model)), limits)
+
+def _send(chat, message, limits):
+    if not limits:
+        return chat.send_message(message)
+    return collect(chat.send_message_stream(message), limits)
+
+def _chat_config(config, limits, model): #* The limits go into the chat's config, a per-message config would replace the summary
+    return stream_config(limits, model, config) if limits else config
+
+def ask_AI(client, model, question, attachments, db, thread_id, user_id, plan=None):
+    limits = plan_limits(plan)
     try:
         if user_id == 0: #* Not registered = Ignore Previous Conversations, Ignore Attachments 
-            response = client.models.generate_content(
-                model=model, contents=question
-            )
+            response = _generate(client, model, question, limits)
             if response.text:
                 return response
             else:
                 print("No answer received from AI.1")
 
-        result = db.find_one({"threadID": thread_id})
-        if not result: #* No previous conversation found 
+        conversation = load_history(db, thread_id)
+        if conversation is None: #* No previous conversation found 
             print(f"No previous conversation found for thread ID: {thread_id}.")
 
+            refs = _store(attachments)
+            content = question
             if attachments:
-                attachments_raw = []
-                size = 0
-
-                for attachment in attachments:
-                    if attachment["mimeType"] in ALLOWED_FILE_TYPES:
-                        size += attachment["size"]
-                        if size > 19900000: #* If the total size of attachments is larger than 19,90 MB
-                            break
-
-                        x = types.Part.from_bytes(data=attachment["data"], mime_type=attachment["mimeType"],)
-                        attachments_raw.append(x)
-
-                content = [question] + attachments_raw
-                response = client.models.generate_content(model=model, contents=content)
-                if response.text:
-                    return response
-                else :
-                    print("No answer received from AI.2.1")
+                content = [question] + build_parts(client, attachments, attachment_store) #* Inline up to 19,90 MB, larger files are uploaded (once per content)
+            response = _generate(client, model, content, limits)
+            if response.text:
+                message = seal_turn(keyring, question, response.text) #* One envelope for both texts
+                db.append(thread_id, user_id, message, refs) #* Creates the conversation, with references to its attachments
+                history_cache.put(thread_id, Conversation(to_contents(question, response.text), attachments=refs))
+
+                return response
             else:
-                response = client.models.generate_content(
-                    model=model, contents=question
-                )
-                if response.text:
-                    history = []
-                    message = {"user": seal(aesgcm, question), "model": seal(aesgcm, response.text)} 
-                    history.append(message)
-
-                    newConvo = { "threadID": thread_id, "user_id": user_id, "history": history, "expireAt": datetime.now() + timedelta(days=7)}
-                    db.insert_one(newConvo)
-
-                    return response
-                else:
-                    print("No answer received from AI.2.2")
-
-        elif result != None: #* Previous conversation found (but ignore attachments)
-            chat_history = []
-            for message in result["history"]:
-                user_msg = open_sealed(aesgcm, message["user"])
-                model_msg = open_sealed(aesgcm, message["model"])
-                x = types.Content(role="user", parts=[types.Part(text=user_msg)])
-                y = types.Content(role="model", parts=[types.Part(text=model_msg)])
-                chat_history.append(x)
-                chat_history.append(y)
-
-            chat = client.chats.create(model=model, history=chat_history)
-            response = chat.send_message(question)
+                print("No answer received from AI.2")
 
-            if response.text:
-                history = result["history"]
-                message = {"user": seal(aesgcm, question), "model": seal(aesgcm, response.text)}
-                history.append(message)
+        else: #* Previous conversation found, the attachments of earlier turns are sent again from the store
+            refs = _store(attachments)
+            stored = _stored_attachments(conversation, attachments)
+            try:
+                parts = build_parts(client, stored + attachments, attachment_store) if stored or attachments else []
+                chat_history, config = context_manager.build_context(conversation, model) #* Summary + last turns within the token budget
+                chat = client.chats.create(model=model, history=chat_history, config=_chat_config(config, limits, model))
+                response = _send(chat, [question] + parts if parts else question, limits)
+            finally:
+                close_all(stored)
 
-                newValues = { "$set": { "history": history, "expireAt": datetime.now() + timedelta(days=7)}}
-                db.update_one({"threadID": thread_id}, newValues)
+            if response.text:
+                message = seal_turn(keyring, question, response.text) #* One envelope for both texts
+                db.append(thread_id, user_id, message, refs) #* Atomic $push, only the new turn is written
+                history_cache.append(thread_id, question, response.text, refs)
+                context_manager.schedule_fold(client, db, keyring, thread_id, model, DEFAULT_MODEL, plan)
 
                 return response
             else:
                 print("No answer received from AI.3")
 
     except Exception as e:
+        if is_model_error(e):
+            raise #* The model router records it and asks another model
         print(f"Error generating AI content: {e}")
 
-        if "The model is overloaded" in str(e):
-            print("Model is overloaded, retrying with backup model...")
-            return "OVERLOADED"
+async def _generate_async(client, model, contents, limits):
+    if not limits:
+        return await client.aio.models.generate_content(model=model, contents=contents)
+    return await collect_async(client.aio.models.generate_content_stream(model=model, contents=contents, config=stream_config(limits, model)), limits)
 
-def send_reply(service, to, subject, thread_id, message_id, message_text, model, plan, cost, remaining_tokens):
-    reply_start_time = time.perf_counter()
+async def _send_async(chat, message, limits):
+    if not limits:
+        return await chat.send_message(message)
+    return await collect_async(chat.send_message_stream(message), limits)
 
-    html_content = create_email_body(message_text, model, plan, cost, remaining_tokens, thread_id)
-    if not html_content:
+async def ask_AI_async(client, model, question, attachments, db, thread_id, user_id, plan=None):
+    """Same flow as ask_AI(), but uses client.aio and an AsyncConversationStore, so it never blocks the event loop."""
+    limits = plan_limits(plan)
+    try:
+        if user_id == 0: #* Not registered = Ignore Previous Conversations, Ignore Attachments
+            response = await _generate_async(client, model, question, limits)
+            if response.text:
+                return response
+            else:
+                print("No answer received from AI.1")
+
+        conversation = await load_history_async(db, thread_id)
+        if conversation is None: #* No previous conversation found
+            print(f"No previous conversation found for thread ID: {thread_id}.")
+
+            refs = await asyncio.to_thread(_store, attachments) #* File IO and uploads are blocking
+            content = question
+            if attachments:
+                await reserve_inline_async(attachments) #* On the loop, a blocked executor thread could be one the budget holders need
+                content = [question] + await asyncio.to_thread(build_parts, client, attachments, attachment_store)
+            response = await _generate_async(client, model, content, limits)
+            if response.text:
+                message = seal_turn(keyring, question, response.text) #* One envelope for both texts
+                await db.append(thread_id, user_id, message, refs)
+                history_cache.put(thread_id, Conversation(to_contents(question, response.text), attachments=refs))
+                return response
+            else:
+                print("No answer received from AI.2")
+
+        else: #* Previous conversation found, the attachments of earlier turns are sent again from the store
+            refs = await asyncio.to_thread(_store, attachments)
+            stored = await asyncio.to_thread(_stored_attachments, conversation, attachments)
+            try:
+                await reserve_inline_async(stored + attachments)
+                parts = await asyncio.to_thread(build_parts, client, stored + attachments, attachment_store) if stored or attachments else []
+                chat_history, config = context_manager.build_context(conversation, model)
+                chat = client.aio.chats.create(model=model, history=chat_history, config=_chat_config(config, limits, model))
+                response = await _send_async(chat, [question] + parts if parts else question, limits)
+            finally:
+                close_all(stored)
+            if response.text:
+                message = seal_turn(keyring, question, response.text) #* One envelope for both texts
+                await db.append(thread_id, user_id, message, refs)
+                history_cache.append(thread_id, question, response.text, refs)
+                context_manager.schedule_fold_async(client, db, keyring, thread_id, model, DEFAULT_MODEL, plan)
+                return response
+            else:
+                print("No answer received from AI.3")
+
+    except Exception as e:
+        if is_model_error(e):
+            raise #* The model router records it and asks another model
+        print(f"Error generating AI content: {e}")
+
+def queue_reply(outbox, service, to, subject, thread_id, message_id, msg_ids, message_text, model, plan, cost, remaining_tokens):
+    """Renders the reply and hands it to the outbox, which sends it and labels the messages "answered"."""
+    with metrics.timer("render_seconds"):
+        body = build_reply(to, subject, thread_id, message_id, message_text, model, plan, cost, remaining_tokens)
+    if not body:
         print("Error: HTML content is empty. Cannot send reply.")
-        mark_label(service, message_id, LABELS["broken"])
+        mark_labels(service, msg_ids, LABELS["broken"])
         return
-    
-    top_img = requests.get("https://placehold.co/970x40/057dc7/fff/jpg?text=Placeholder")
-    top_img_data = top_img.content
-    bottom_img = requests.get("https://placehold.co/970x20/057dc7/fff/jpg?text=Placeholder")
-    bottom_img_data = bottom_img.content
+    if not outbox.enqueue(thread_id, message_id, msg_ids, body):
+        print(f"A reply to '{message_id}' is already queued, not sending it twice.")
 
-    message = MIMEMultipart(_subtype='related')
-    html_body = MIMEText(html_content, _subtype='html')
-    message.attach(html_body)
+def build_reply(to, subject, thread_id, message_id, message_text, model, plan, cost, remaining_tokens): #* Returns the messages.send body, or None
+    html_content = create_email_body(message_text, model, plan, cost, remaining_tokens, thread_id)
+    if not html_content:
+        return None
 
-    top_img = MIMEImage(top_img_data, 'jpeg')
-    top_img.add_header('Content-Id', '<top_banner>')
-    top_img.add_header("Content-Disposition", "inline", filename="top_banner")
-    message.attach(top_img)
+    alternative = MIMEMultipart(_subtype='alternative') #* Plain text first, clients show the last part they support
+    alternative.attach(MIMEText(create_plain_body(message_text, model, plan, cost, remaining_tokens, thread_id), _subtype='plain', _charset='utf-8'))
+    alternative.attach(MIMEText(html_content, _subtype='html', _charset='utf-8'))
 
-    bottom_img = MIMEImage(bottom_img_data, 'jpeg')
-    bottom_img.add_header('Content-Id', '<bottom_banner>')
-    bottom_img.add_header("Content-Disposition", "inline", filename="bottom_banner")
-    message.attach(bottom_img)
+    message = MIMEMultipart(_subtype='related')
+    message.attach(alternative)
+    for banner in banner_parts(): #* Loaded and encoded once at startup, shared by all replies
+        message.attach(banner)
 
     message['to'] = to
     message['subject'] = "Re: " + subject
     message['In-Reply-To'] = message_id
     message['References'] = message_id
+    message['Message-ID'] = reply_message_id(thread_id, message_id) #* Lets the outbox find it in Gmail after a send with unknown outcome
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    body = {'raw': raw_message, 'threadId': thread_id}
-    
-    try:
-        with gmail_lock:
-            service.users().messages().send(userId='me', body=body).execute()
-            print(f"Replying to '{message_id}' <> '{thread_id}'")
-    except Exception as error:
-        print(f'A error happened: {error}')
-
-    reply_end_time = time.perf_counter()
-    print(f"Reply building and sending took {reply_end_time - reply_start_time:.2f} seconds.")
\ No newline at end of file
+    return {'raw': raw_message, 'threadId': thread_id}
\ No newline at end of file
@@ -0,0 +1,140 @@
+import os
+import time
+import asyncio
+
+import httpx
+
+from clients import genai_types as types
+from registry import registry
+from metrics import metrics
+
+AI_STREAMING = os.getenv("AI_STREAMING", "on") #* "on" (streamed, with the limits below) or "off" (one blocking request without limits)
+
+#* Per plan: seconds until an answer is cut off and max. characters of an answer
+PLAN_LIMITS = {
+    "Developer": {"deadline": float(os.getenv("DEVELOPER_AI_DEADLINE", "300")), "max_chars": int(os.getenv("DEVELOPER_AI_MAX_CHARS", "100000"))},
+    "Premium": {"deadline": float(os.getenv("PREMIUM_AI_DEADLINE", "180")), "max_chars": int(os.getenv("PREMIUM_AI_MAX_CHARS", "60000"))},
+    "Free": {"deadline": float(os.getenv("FREE_AI_DEADLINE", "90")), "max_chars": int(os.getenv("FREE_AI_MAX_CHARS", "20000"))},
+    "Unregistered": {"deadline": float(os.getenv("UNREGISTERED_AI_DEADLINE", "45")), "max_chars": int(os.getenv("UNREGISTERED_AI_MAX_CHARS", "8000"))}
+}
+CHARS_PER_TOKEN = 4 #* Same rough estimate as the rate limiter and the context manager
+DEFAULT_MAX_OUTPUT_TOKENS = 8192 #* When a model has no "max_output_tokens" in models.json
+TIMEOUTS = (TimeoutError, httpx.TimeoutException)
+
+CUT_NOTES = {
+    "deadline": "\n\n[This answer was cut off because it took too long to generate.]",
+    "size": "\n\n[This answer was cut off because it got too long.]"
+}
+
+class GenerationTimeout(TimeoutError):
+    """The deadline passed before the model sent any text."""
+
+class StreamedAnswer:
+    """The parts of a GenerateContentResponse the callers use. `cut` is the reason the stream was stopped early, if it was."""
+
+    def __init__(self, text, usage_metadata, cut=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self.cut = cut
+
+def plan_limits(plan):
+    """Limits for a plan, or None when streaming is off."""
+    if AI_STREAMING != "on":
+        return None
+    return PLAN_LIMITS.get(plan, PLAN_LIMITS["Unregistered"])
+
+def stream_config(limits, model, config=None):
+    """`config` plus a server side cap on the output and a HTTP timeout, so a stalled connection can not outlive the deadline."""
+    model_limit = registry.models.get(model, {}).get("max_output_tokens", DEFAULT_MAX_OUTPUT_TOKENS)
+    update = {
+        "max_output_tokens": min(limits["max_chars"] // (CHARS_PER_TOKEN - 1), model_limit), #* Some headroom, the buffer normally cuts first
+        "http_options": types.HttpOptions(timeout=int(limits["deadline"] * 1000))
+    }
+    return config.model_copy(update=update) if config else types.GenerateContentConfig(**update)
+
+class AnswerBuffer:
+    """Collects streamed chunks up to max_chars. Everything after the limit or the deadline is never read."""
+
+    def __init__(self, limits):
+        self.max_chars = limits["max_chars"]
+        self.deadline = time.monotonic() + limits["deadline"]
+        self.parts = []
+        self.size = 0
+        self.usage = None #* usage_metadata of the last chunk that had one, the final chunk has the full count
+        self.cut = None
+
+    def add(self, chunk):
+        """Returns False when the stream has to be stopped."""
+        if chunk.usage_metadata:
+            self.usage = chunk.usage_metadata
+        text = chunk.text or ""
+        if self.size + len(text) > self.max_chars:
+            text = text[:self.max_chars - self.size]
+            self.cut = "size"
+        self.parts.append(text)
+        self.size += len(text)
+        if not self.cut and chunk.candidates and chunk.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS: #* Server side cap
+            self.cut = "size"
+        if not self.cut and time.monotonic() >= self.deadline:
+            self.cut = "deadline"
+        return self.cut is None
+
+    def timed_out(self, error):
+        if not self.size:
+            raise GenerationTimeout(f"No answer within the deadline ({str(error) or 'timeout'}).") from error
+        self.cut = "deadline"
+
+    def _usage(self):
+        if self.usage and not self.cut:
+            return self.usage
+        #* Stopped before the final chunk: the last counts seen, the output at least as long as what was read
+        prompt = getattr(self.usage, "prompt_token_count", None) or 0
+        output = max(getattr(self.usage, "candidates_token_count", None) or 0, self.size // CHARS_PER_TOKEN)
+        total = max(getattr(self.usage, "total_token_count", None) or 0, prompt + output)
+        return types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt, candidates_token_count=output, total_token_count=total)
+
+    def answer(self):
+        text = "".join(self.parts)
+        if self.cut:
+            metrics.inc("ai_stream_cut_total", reason=self.cut)
+            print(f"Answer cut off ({self.cut}) after {self.size} characters.")
+            text += CUT_NOTES[self.cut]
+        return StreamedAnswer(text if self.size else None, self._usage(), self.cut)
+
+def collect(stream, limits):
+    """Reads a generate_content_stream()/send_message_stream() iterator into a StreamedAnswer.
+
+    The deadline is checked after every chunk and the HTTP timeout from stream_config()
+    bounds the wait for a single chunk, so a call takes at most about twice the deadline.
+    A GenerationTimeout is not retried on another model, so this is also the bound per message.
+    """
+    buffer = AnswerBuffer(limits)
+    try:
+        for chunk in stream:
+            if not buffer.add(chunk):
+                break
+    except TIMEOUTS as e:
+        buffer.timed_out(e)
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close() #* Closes the HTTP response, the rest of the answer is not read
+    return buffer.answer()
+
+async def collect_async(start, limits):
+    """Same as collect() for the awaitable of an async stream. The deadline is enforced by the event loop, also while waiting."""
+    buffer = AnswerBuffer(limits)
+    stream = None
+    try:
+        async with asyncio.timeout(limits["deadline"]):
+            stream = await start
+            async for chunk in stream:
+                if not buffer.add(chunk):
+                    break
+    except TIMEOUTS as e:
+        buffer.timed_out(e)
+    finally:
+        close = getattr(stream, "aclose", None)
+        if close:
+            await close()
+    return buffer.answer()
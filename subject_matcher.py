@@ -0,0 +1,95 @@
+import re
+
+SEPARATORS = (",", ";", "_", "/") #* Count as a space between words, so they can never be part of a model name
+FLAGS = ("reasoning",) #* Parameters that are simply on/off, add new ones here
+
+def _trie_pattern(names):
+    """Builds one regex out of all names with shared prefixes factored out (gemini-(?:1\\.5-(?:flash|pro)|...)).
+
+    Longer continuations are tried first, so at every position the longest name wins.
+    """
+    trie = {}
+    for name in names:
+        node = trie
+        for ch in name:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        alternatives = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != ""]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+def _has_overlap(names):
+    """True if a proper suffix of one name is the prefix of a longer name (e.g. "pro-x" / "x-ultra")."""
+    for a in names:
+        for b in names:
+            if len(b) > len(a) and any(b.startswith(a[i:]) for i in range(1, len(a))):
+                return True
+    return False
+
+class SubjectMatcher:
+    """Finds the model and all parameters in a subject with one compiled regex and a single scan.
+
+    Gives the same model as the old "sort by length, first substring hit". Only when
+    model names can overlap, the model part becomes a lookahead, so no longer name
+    is hidden inside an earlier match.
+    """
+
+    def __init__(self, models):
+        names = sorted(models.keys(), key=lambda m: len(m), reverse=True)
+        names = [name for name in names if not any(sep in name for sep in SEPARATORS)]
+        self._rank = {name: i for i, name in enumerate(names)} #* Lower rank = longer name (ties keep models.json order)
+
+        model_pattern = _trie_pattern(names) or "(?!)"
+        if _has_overlap(names):
+            model_pattern = f"(?=({model_pattern}))"
+        else:
+            model_pattern = f"({model_pattern})"
+        flag_pattern = "|".join(re.escape(flag) for flag in FLAGS)
+
+        #* Word ends are checked with (?![^\W_]) instead of \b, because "_" counts as a separator.
+        #* The start of a word is checked in match(), a leading assertion would make the regex scan a lot slower.
+        self._pattern = re.compile(rf"{model_pattern}|({flag_pattern})(?![^\W_])|id-(\d+)(?![^\W_])")
+
+    def match(self, subject, default_model):
+        s = subject.lower()
+
+        found_model = None
+        flags = set()
+        ids = []
+        for m in self._pattern.finditer(s):
+            model, flag, thread_id = m.groups()
+            if model:
+                if found_model is None or self._rank[model] < self._rank[found_model]:
+                    found_model = model
+                continue
+
+            start = m.start()
+            if start and s[start - 1].isalnum(): #* Not the start of a word
+                continue
+            if flag:
+                flags.add(flag)
+            else:
+                ids.append(thread_id)
+
+        return {
+            "model": found_model or default_model, #* If no model found, set to default
+            "reasoning": "reasoning" in flags,
+            "flags": flags,
+            "ids": ids
+        }
+
+_cache = (None, None) #* (models dict, matcher); the registry replaces the dict on every reload
+
+def get_matcher(models):
+    global _cache
+    cached_models, matcher = _cache
+    if cached_models is not models:
+        matcher = SubjectMatcher(models)
+        _cache = (models, matcher)
+    return matcher
@@ -0,0 +1,97 @@
+import threading
+
+ANSWER = "answer" #* Thread was idle, answer the message now
+HELD = "held" #* Thread is busy here, the message waits for the next turn
+ELSEWHERE = "elsewhere" #* Another instance holds the thread lease
+RUNNING = "running" #* The message is part of the current turn, e.g. listed again by reclaim
+
+class ThreadQueue:
+    """Email threads that are being answered, with the messages that arrived on them in the meantime.
+
+    Only one turn per thread runs at a time. Messages for a busy thread are held
+    and handed back by `finish()`, so they can be answered together as one turn.
+    With `leases` set, a thread is also leased while it is active, so other
+    instances sharing the inbox leave it alone. `on_lease(thread_id)` runs after
+    a lease was taken, the thread may have changed while another instance held it.
+    The lease is also kept while the outbox still has to send a reply of the thread,
+    see `deliver()`, otherwise another instance would see the message as stuck.
+    """
+
+    def __init__(self, leases=None, on_lease=None):
+        self.leases = leases
+        self.on_lease = on_lease
+        self._pending = {} #* thread_id -> held messages, present while the thread is active
+        self._running = {} #* thread_id -> ids of the messages in the current turn
+        self._delivering = {} #* thread_id -> number of replies the outbox has not finished
+        self._lock = threading.Lock()
+
+    def __contains__(self, thread_id):
+        with self._lock:
+            return thread_id in self._pending
+
+    def claim(self, message):
+        """Returns ANSWER, HELD, RUNNING or ELSEWHERE."""
+        with self._lock: #* Lease calls run under the lock, so claim() and finish() of one thread can not interleave
+            held = self._pending.get(message['threadId'])
+            if held is None:
+                if self.leases:
+                    if not self.leases.acquire(lease_key(message['threadId'])):
+                        return ELSEWHERE
+                    if self.on_lease:
+                        self.on_lease(message['threadId'])
+                self._pending[message['threadId']] = []
+                self._running[message['threadId']] = {m['id'] for m in job_messages(message)}
+                return ANSWER
+            if message['id'] in self._running[message['threadId']]:
+                return RUNNING
+            if all(m['id'] != message['id'] for m in held): #* The plain UNREAD listing can return it again
+                held.append(message)
+            return HELD
+
+    def finish(self, thread_id):
+        """Ends the current turn. Returns the held messages (the thread stays active for them) or an empty list."""
+        with self._lock:
+            held = self._pending.pop(thread_id, [])
+            if held:
+                self._pending[thread_id] = []
+                self._running[thread_id] = {m['id'] for m in held}
+                return held
+            self._running.pop(thread_id, None)
+            if thread_id not in self._delivering: #* Otherwise delivered() releases the lease
+                self._release(thread_id)
+            return held
+
+    def deliver(self, thread_id):
+        """A reply of the thread waits in the outbox. False if the lease is held by another instance, then it must not be sent."""
+        with self._lock:
+            if self.leases and thread_id not in self._pending and thread_id not in self._delivering: #* Left over from the last run
+                if not self.leases.acquire(lease_key(thread_id)):
+                    return False
+            self._delivering[thread_id] = self._delivering.get(thread_id, 0) + 1
+            return True
+
+    def delivered(self, thread_id):
+        """The outbox finished (sent or gave up on) a reply registered with deliver()."""
+        with self._lock:
+            count = self._delivering.pop(thread_id, 1) - 1
+            if count:
+                self._delivering[thread_id] = count
+            elif thread_id not in self._pending: #* An active turn releases it in finish()
+                self._release(thread_id)
+
+    def _release(self, thread_id):
+        if self.leases:
+            try:
+                self.leases.release(lease_key(thread_id))
+            except Exception as e: #* Expires on its own after the TTL
+                print(f"Could not release the lease of thread {thread_id}: {e}")
+
+def lease_key(thread_id):
+    return f"thread:{thread_id}"
+
+def merge(messages):
+    """One job for several messages of a thread: the first one carries the others as "followups"."""
+    return dict(messages[0], followups=messages[1:])
+
+def job_messages(message):
+    return [message] + message.get("followups", [])